@@ -5,6 +5,7 @@ setup(
    version='1.0',
    author='William N. Havard',
    author_email='william.havard@gmail.com',
-   packages=['speechcoco']
+   packages=['speechcoco'],
    package_dir = {'speechcoco': 'speechcoco'},
+   extras_require = {'numpy': ['numpy']},
 )
\ No newline at end of file
@@ -0,0 +1,264 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import asyncio
+import functools
+import itertools
+from collections import deque
+from concurrent.futures import ThreadPoolExecutor
+
+from .speechcoco import SpeechCoco, Caption, FETCH_SIZE
+
+'''
+    File name: asynchronous.py
+    asyncio interface of SpeechCoco: queries run on a pool of threads (each one with its own connections to the
+    databases), so that they don't block the event loop.
+    Requires Python 3.7+.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+#
+# CONSTANTS
+#
+
+# Number of threads running the queries
+ASYNC_WORKERS = 4
+
+
+#
+#   Asynchronous SpeechCoco
+#
+
+class AsyncSpeechCoco(object):
+    """
+    asyncio facade of SpeechCoco. Every query runs on a dedicated pool of threads, each thread using its own
+    connections to the databases (see SpeechCoco), hence many lookups can be awaited concurrently, e.g. with
+    asyncio.gather. Captions can also be streamed with iterCaptions (async for).
+    """
+
+    def __init__(self, databaseDir, translationDir='', verbose=False, cacheSize=1024, wavDir='', readOnly=True,
+                 workers=ASYNC_WORKERS):
+        """
+        :param databaseDir: see SpeechCoco
+        :param translationDir: see SpeechCoco
+        :param verbose: see SpeechCoco
+        :param cacheSize: see SpeechCoco
+        :param wavDir: see SpeechCoco
+        :param readOnly: see SpeechCoco
+        :param workers: number of threads running the queries
+        """
+        self.speechCoco = SpeechCoco(databaseDir, translationDir, verbose=verbose, cacheSize=cacheSize, wavDir=wavDir,
+                                     readOnly=readOnly)
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+
+    async def __aenter__(self):
+        return self
+
+    async def __aexit__(self, *args):
+        await self.close()
+
+    async def close(self):
+        """
+        Waits for the running queries, then closes the connections.
+
+        :return:
+        """
+        await asyncio.get_running_loop().run_in_executor(None, functools.partial(self._executor.shutdown, wait=True))
+        self.speechCoco.close()
+
+    async def _run(self, function, *args, **kwargs):
+        return await asyncio.get_running_loop().run_in_executor(self._executor,
+                                                                functools.partial(function, *args, **kwargs))
+
+    #
+    #   Queries
+    #
+
+    async def getSpeakers(self, nationality=[], gender=[], raw=False):
+        """
+        See SpeechCoco.getSpeakers.
+        """
+        return await self._run(self.speechCoco.getSpeakers, nationality=nationality, gender=gender, raw=raw)
+
+    async def getImgID(self, pageSize=None, pageToken=None):
+        """
+        See SpeechCoco.getImgID.
+        """
+        return await self._run(self.speechCoco.getImgID, pageSize=pageSize, pageToken=pageToken)
+
+    async def getImgCaptions(self, imgID, raw=False, pageSize=None, pageToken=None):
+        """
+        See SpeechCoco.getImgCaptions.
+        """
+        return await self._run(self.speechCoco.getImgCaptions, imgID, raw=raw, pageSize=pageSize, pageToken=pageToken)
+
+    async def filterCaptions(self, **kwargs):
+        """
+        See SpeechCoco.filterCaptions (use iterCaptions to stream the results).
+        """
+        kwargs['stream'] = False
+        return await self._run(self.speechCoco.filterCaptions, **kwargs)
+
+    async def selectCaptions(self, captionID, raw=False, pageSize=None, pageToken=None):
+        """
+        See SpeechCoco.selectCaptions.
+        """
+        return await self._run(self.speechCoco.selectCaptions, captionID, raw=raw, pageSize=pageSize,
+                               pageToken=pageToken)
+
+    async def queryCaptions(self, query):
+        """
+        See SpeechCoco.queryCaptions.
+        """
+        return await self._run(self.speechCoco.queryCaptions, query)
+
+    async def findWordOccurrences(self, word, **kwargs):
+        """
+        See SpeechCoco.findWordOccurrences.
+        """
+        kwargs['stream'] = False
+        return await self._run(self.speechCoco.findWordOccurrences, word, **kwargs)
+
+    async def getAlignment(self, captionID, seconds=False):
+        """
+        See SpeechCoco.getAlignment.
+        """
+        return await self._run(self.speechCoco.getAlignment, captionID, seconds=seconds)
+
+    async def stats(self, groupBy=['speaker'], **kwargs):
+        """
+        See SpeechCoco.stats.
+        """
+        return await self._run(self.speechCoco.stats, groupBy=groupBy, **kwargs)
+
+    def iterCaptions(self, batchSize=FETCH_SIZE, **kwargs):
+        """
+        Streams the captions matching the filters (see SpeechCoco.filterCaptions):
+
+            async for caption in db.iterCaptions(speaker='Paul'):
+                ...
+
+        :param batchSize: number of captions fetched at a time
+        :param kwargs: filters accepted by filterCaptions
+        :return: AsyncCaptionStream
+        """
+        return AsyncCaptionStream(self.speechCoco, kwargs, batchSize)
+
+    #
+    #   Translations
+    #
+
+    async def getLanguages(self):
+        """
+        See SpeechCoco.getLanguages.
+        """
+        return await self._run(self.speechCoco.getLanguages)
+
+    async def getTranslation(self, captionID, language):
+        """
+        See SpeechCoco.getTranslation.
+        """
+        return await self._run(self.speechCoco.getTranslation, captionID, language)
+
+    async def getTokens(self, captionID, language):
+        """
+        See SpeechCoco.getTokens.
+        """
+        return await self._run(self.speechCoco.getTokens, captionID, language)
+
+    async def getPOS(self, captionID, language):
+        """
+        See SpeechCoco.getPOS.
+        """
+        return await self._run(self.speechCoco.getPOS, captionID, language)
+
+    async def getTranslations(self, captionID, language, fields=['caption']):
+        """
+        See SpeechCoco.getTranslations.
+        """
+        return await self._run(self.speechCoco.getTranslations, captionID, language, fields=fields)
+
+    #
+    #   Audio
+    #
+
+    async def getWavBytes(self, caption):
+        """
+        :param caption: Caption object or WAV filename
+        :return: content of the WAV file of the caption
+        """
+        assert self.speechCoco._wavDir != '', "|> No WAV directory given!"
+        filename = caption.filename if isinstance(caption, Caption) else caption
+        return await self._run(_readFile, os.path.join(self.speechCoco._wavDir, filename))
+
+    async def getSegmentAudio(self, caption, begin, end, seconds=True):
+        """
+        See SpeechCoco.getSegmentAudio (requires NumPy).
+        """
+        return await self._run(self.speechCoco.getSegmentAudio, caption, begin, end, seconds=seconds)
+
+
+def _readFile(path):
+    with open(path, 'rb') as f:
+        return f.read()
+
+
+#
+#   Streaming
+#
+
+class AsyncCaptionStream(object):
+    """
+    Asynchronous iterator over the captions matching filters. The rows are fetched batchSize at a time by a
+    thread of its own, so that the cursor is always used by the same thread (and connection).
+    """
+
+    def __init__(self, speechCoco, filters, batchSize=FETCH_SIZE):
+        self._speechCoco = speechCoco
+        self._filters = dict(filters, stream=True)
+        self._batchSize = batchSize
+        self._executor = ThreadPoolExecutor(max_workers=1)
+        self._captions = None
+        self._buffer = deque()
+        self._done = False
+
+    def __aiter__(self):
+        return self
+
+    async def __anext__(self):
+        if len(self._buffer) == 0 and not self._done:
+            batch = await asyncio.get_running_loop().run_in_executor(self._executor, self._nextBatch)
+            self._buffer.extend(batch)
+            if len(batch) < self._batchSize:
+                await self.aclose()
+        if len(self._buffer) == 0:
+            raise StopAsyncIteration
+        return self._buffer.popleft()
+
+    def _nextBatch(self):
+        if self._captions is None:
+            self._captions = self._speechCoco.filterCaptions(**self._filters)
+        return list(itertools.islice(self._captions, self._batchSize))
+
+    def _closeCaptions(self):
+        # the generator (and its cursor) is closed by the thread that created it, then the connections of the
+        # thread, so that finished streams don't keep connections open
+        if self._captions is not None:
+            self._captions.close()
+            self._captions = None
+        self._speechCoco.closeThread()
+
+    async def aclose(self):
+        """
+        Stops the stream (the captions already fetched are still returned).
+
+        :return:
+        """
+        if not self._done:
+            self._done = True
+            await asyncio.get_running_loop().run_in_executor(self._executor, self._closeCaptions)
+            self._executor.shutdown(wait=False)
@@ -0,0 +1,386 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import mmap
+import time
+import random
+import struct
+import sqlite3
+import numpy as np
+from collections import OrderedDict
+
+'''
+    File name: audio.py
+    Memory-mapped access to the samples of the WAV files of SpeechCoco.
+    Requires NumPy.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+#
+# CONSTANTS
+#
+
+# WAVE format tags
+WAVE_FORMAT_PCM = 1
+WAVE_FORMAT_IEEE_FLOAT = 3
+WAVE_FORMAT_EXTENSIBLE = 0xFFFE
+
+# Sample types ((format, bits per sample) -> NumPy dtype)
+SAMPLE_TYPES = {(WAVE_FORMAT_PCM, 8): np.uint8,
+                (WAVE_FORMAT_PCM, 16): np.dtype('<i2'),
+                (WAVE_FORMAT_PCM, 32): np.dtype('<i4'),
+                (WAVE_FORMAT_IEEE_FLOAT, 32): np.dtype('<f4'),
+                (WAVE_FORMAT_IEEE_FLOAT, 64): np.dtype('<f8')}
+
+# Maximum number of WAV files kept mapped by extractOccurrences
+MAX_OPEN_FILES = 16
+
+# Audio shards (see packShards): maximum size of a shard file, alignment of the payloads within a shard and
+# name of the shards (each run of packShards writes a new generation of shards)
+SHARD_SIZE = 1 << 30
+SHARD_ALIGNMENT = 16
+SHARD_FILENAME = 'shard-{}-{:05d}.pcm'
+
+
+#
+#   WAV file
+#
+
+class WavFile(object):
+    """
+    WAV file whose PCM data is memory-mapped. Samples are returned as read-only NumPy views of the mapping
+    (nothing is copied nor read from the disk before the samples are accessed). The mapping stays alive as long
+    as a view of it exists, even after close().
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path, 'rb') as f:
+            self._data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        self._parseHeader()
+
+    def _parseHeader(self):
+        data = self._data
+        if data[0:4] != b'RIFF' or data[8:12] != b'WAVE':
+            raise ValueError("{} is not a WAV file".format(self.path))
+
+        position = 12
+        fmt = None
+        self._offset = None
+        while position + 8 <= len(data):
+            chunkID = data[position:position + 4]
+            chunkSize = struct.unpack('<I', data[position + 4:position + 8])[0]
+            if chunkID == b'fmt ':
+                fmt = struct.unpack('<HHIIHH', data[position + 8:position + 24])
+                if fmt[0] == WAVE_FORMAT_EXTENSIBLE:
+                    # the actual format is the first field of the sub-format GUID
+                    fmt = struct.unpack('<H', data[position + 32:position + 34]) + fmt[1:]
+            elif chunkID == b'data':
+                self._offset = position + 8
+                # the size written in the header may be wrong (e.g. files written by a stream)
+                dataSize = min(chunkSize, len(data) - self._offset)
+                break
+            # chunks are padded to an even size
+            position += 8 + chunkSize + (chunkSize & 1)
+
+        if fmt is None or self._offset is None:
+            raise ValueError("{} has no fmt or data chunk".format(self.path))
+        formatTag, self.channels, self.sampleRate, _, self._blockAlign, bitsPerSample = fmt
+        if (formatTag, bitsPerSample) not in SAMPLE_TYPES:
+            raise ValueError("{}: unsupported sample format ({}, {} bits)".format(self.path, formatTag, bitsPerSample))
+        self.dtype = np.dtype(SAMPLE_TYPES[(formatTag, bitsPerSample)])
+        self.sampleWidth = self.dtype.itemsize
+        self.frames = dataSize // self._blockAlign
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+    def close(self):
+        # the mapping itself is released once the views of it are garbage collected
+        self._data = None
+
+    def duration(self):
+        return self.frames / float(self.sampleRate)
+
+    def toFrame(self, time, seconds=True):
+        """
+        :param time:
+        :param seconds: True if time is in seconds, False if in milliseconds
+        :return: index of the frame at time, clipped to the length of the file
+        """
+        if seconds == False:
+            time = time / 1000.0
+        return min(max(int(round(time * self.sampleRate)), 0), self.frames)
+
+    def samples(self, begin=None, end=None, seconds=True):
+        """
+        :param begin: defaults to the beginning of the file
+        :param end: defaults to the end of the file
+        :param seconds: True if begin and end are in seconds, False if in milliseconds
+        :return: read-only view of the samples between begin and end, of shape (frames,) for mono files and
+                 (frames, channels) otherwise
+        """
+        first = 0 if begin is None else self.toFrame(begin, seconds)
+        last = self.frames if end is None else self.toFrame(end, seconds)
+        count = max(last - first, 0)
+        samples = np.frombuffer(self._data, dtype=self.dtype, count=count * self.channels,
+                                offset=self._offset + first * self._blockAlign)
+        if self.channels > 1:
+            samples = samples.reshape(count, self.channels)
+        return samples
+
+
+def getSegment(path, begin, end, seconds=True):
+    """
+    :param path: WAV file
+    :param begin:
+    :param end:
+    :param seconds: True if begin and end are in seconds, False if in milliseconds
+    :return: read-only view of the samples between begin and end (see WavFile.samples)
+    """
+    with WavFile(path) as wavFile:
+        return wavFile.samples(begin, end, seconds)
+
+
+#
+#   Batch extraction
+#
+
+class WavFiles(object):
+    """
+    Keeps the last maxOpen WAV files of a directory mapped.
+    """
+
+    def __init__(self, wavDir, maxOpen=MAX_OPEN_FILES):
+        self.wavDir = wavDir
+        self.maxOpen = maxOpen
+        self._files = OrderedDict()
+
+    def get(self, filename):
+        wavFile = self._files.pop(filename, None)
+        if wavFile is None:
+            wavFile = WavFile(os.path.join(self.wavDir, filename))
+            if len(self._files) >= self.maxOpen:
+                self._files.popitem(last=False)[1].close()
+        self._files[filename] = wavFile
+        return wavFile
+
+    def close(self):
+        for wavFile in self._files.values():
+            wavFile.close()
+        self._files.clear()
+
+
+def extractOccurrences(occurrences, wavDir, padding=0.0, maxOpen=MAX_OPEN_FILES):
+    """
+    Cuts the audio of many occurrences (e.g. the rows of SpeechCoco.findWordOccurrences). Occurrences are
+    processed one at a time and at most maxOpen files are mapped at once, so memory use doesn't depend on the
+    number of occurrences.
+
+    :param occurrences: iterable of rows (or dicts) with wavFilename, begin and end (seconds) fields
+    :param wavDir: directory of the WAV files
+    :param padding: seconds added before and after each occurrence
+    :param maxOpen: maximum number of WAV files mapped at once
+    :return: generator yielding (occurrence, samples) pairs
+    """
+    wavFiles = WavFiles(wavDir, maxOpen)
+    try:
+        for occurrence in occurrences:
+            wavFile = wavFiles.get(occurrence['wavFilename'])
+            yield occurrence, wavFile.samples(occurrence['begin'] - padding, occurrence['end'] + padding)
+    finally:
+        wavFiles.close()
+
+
+#
+#   Audio shards
+#
+
+def packShards(speechCoco, shardDir, shardSize=SHARD_SIZE, verbose=False, **filters):
+    """
+    Concatenates the PCM data of the WAV files of the captions selected by filters (see
+    SpeechCoco.filterCaptions) into a few large shard files, and indexes them in the audioShards table of the
+    database (captionID, shard, offset, frames, sampleRate, channels, dtype), replacing any previous index.
+    The new shards are written next to the previous ones and the index is replaced in a single transaction, then
+    the previous shards are removed: if packing fails, the previous index and shards are left untouched.
+    The WAV files are read from the wavDir of speechCoco. See ShardStore to read the shards.
+
+    :param speechCoco: SpeechCoco object
+    :param shardDir: directory where the shards are written
+    :param shardSize: a new shard is started when the current one would exceed shardSize bytes
+    :param verbose:
+    :param filters: filters accepted by SpeechCoco.filterCaptions
+    :return: dict with the number of captions, shards, bytes written and the time spent
+    """
+    assert speechCoco._wavDir != '', "|> No WAV directory given!"
+    if not os.path.isdir(shardDir):
+        os.makedirs(shardDir)
+
+    database = speechCoco.database
+    with database:
+        database.execute('CREATE TABLE IF NOT EXISTS audioShards (captionID INTEGER PRIMARY KEY, shard TEXT, '
+                         'offset INTEGER, frames INTEGER, sampleRate INTEGER, channels INTEGER, dtype TEXT)')
+        database.execute('CREATE INDEX IF NOT EXISTS audioShards_shard ON audioShards (shard, offset)')
+    previous = set(shard for (shard,) in database.execute('SELECT DISTINCT shard FROM audioShards'))
+    # the shards of this run never overwrite existing shards (e.g. two runs within the same millisecond)
+    generation = int(time.time() * 1000)
+    while os.path.exists(os.path.join(shardDir, SHARD_FILENAME.format('{:x}'.format(generation), 0))):
+        generation += 1
+    generation = '{:x}'.format(generation)
+
+    report = {'captions': 0, 'shards': 0, 'bytes': 0}
+    startTime = time.time()
+    shard = None
+    written = []
+    rows = []
+    filters['raw'] = True
+    filters['stream'] = True
+    try:
+        try:
+            database.execute('DELETE FROM audioShards')
+            for caption in speechCoco.filterCaptions(**filters):
+                with WavFile(os.path.join(speechCoco._wavDir, caption['wavFilename'])) as wavFile:
+                    payload = wavFile._data[wavFile._offset:wavFile._offset + wavFile.frames * wavFile._blockAlign]
+                    if shard is None or (shard.tell() > 0 and shard.tell() + len(payload) > shardSize):
+                        if shard is not None:
+                            shard.close()
+                        shardName = SHARD_FILENAME.format(generation, report['shards'])
+                        written.append(shardName)
+                        shard = open(os.path.join(shardDir, shardName), 'wb')
+                        report['shards'] += 1
+                    rows.append((caption['captionID'], shardName, shard.tell(), wavFile.frames, wavFile.sampleRate,
+                                 wavFile.channels, wavFile.dtype.str))
+                    shard.write(payload)
+                    # keeps every payload aligned so that its samples can be viewed without copy
+                    shard.write(b'\0' * (-shard.tell() % SHARD_ALIGNMENT))
+                report['captions'] += 1
+                report['bytes'] += len(payload)
+                if len(rows) >= 1000:
+                    database.executemany('INSERT OR REPLACE INTO audioShards VALUES (?,?,?,?,?,?,?)', rows)
+                    rows = []
+                    if verbose == True:
+                        print("\t{} captions packed".format(report['captions']))
+            database.executemany('INSERT OR REPLACE INTO audioShards VALUES (?,?,?,?,?,?,?)', rows)
+        finally:
+            if shard is not None:
+                shard.close()
+    except:
+        # the previous index is restored and the new shards removed
+        database.rollback()
+        for shardName in written:
+            os.remove(os.path.join(shardDir, shardName))
+        raise
+    database.commit()
+    for shardName in previous - set(written):
+        if os.path.exists(os.path.join(shardDir, shardName)):
+            os.remove(os.path.join(shardDir, shardName))
+    report['seconds'] = time.time() - startTime
+
+    if verbose == True:
+        print("|> {captions} captions packed into {shards} shards ({bytes} bytes) in {seconds:0.2f}s".format(**report))
+    return report
+
+
+class ShardStore(object):
+    """
+    Reader of the shards written by packShards. The shards are memory-mapped and samples are returned as
+    read-only NumPy views, so reading a caption costs neither an open nor a stat. When pickled (e.g. sent to a
+    DataLoader worker), only the paths are sent and the shards are mapped again in the receiving process.
+    """
+
+    def __init__(self, databaseDir, shardDir):
+        self.databaseDir = databaseDir
+        self.shardDir = shardDir
+        self._open()
+
+    def _open(self):
+        self._database = sqlite3.connect(self.databaseDir)
+        self._shards = dict()
+
+    def __getstate__(self):
+        return {'databaseDir': self.databaseDir, 'shardDir': self.shardDir}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self._database.execute('SELECT COUNT(*) FROM audioShards').fetchone()[0]
+
+    def __contains__(self, captionID):
+        return self._database.execute('SELECT 1 FROM audioShards WHERE captionID=?', (captionID,)).fetchone() \
+               is not None
+
+    def __iter__(self):
+        return self.iterate()
+
+    def _shard(self, shard):
+        data = self._shards.get(shard)
+        if data is None:
+            with open(os.path.join(self.shardDir, shard), 'rb') as f:
+                data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            self._shards[shard] = data
+        return data
+
+    def _samples(self, shard, offset, frames, channels, dtype):
+        samples = np.frombuffer(self._shard(shard), dtype=np.dtype(dtype), count=frames * channels,
+                                offset=offset)
+        if channels > 1:
+            samples = samples.reshape(frames, channels)
+        return samples
+
+    def getInfo(self, captionID):
+        """
+        :param captionID:
+        :return: (shard, offset, frames, sampleRate, channels, dtype) of the caption
+        """
+        row = self._database.execute('SELECT shard, offset, frames, sampleRate, channels, dtype FROM audioShards '
+                                     'WHERE captionID=?', (captionID,)).fetchone()
+        if row is None:
+            raise KeyError(captionID)
+        return row
+
+    def getSamples(self, captionID):
+        """
+        :param captionID:
+        :return: read-only view of the samples of the caption (see WavFile.samples)
+        """
+        shard, offset, frames, _, channels, dtype = self.getInfo(captionID)
+        return self._samples(shard, offset, frames, channels, dtype)
+
+    def getSampleRate(self, captionID):
+        return self.getInfo(captionID)[3]
+
+    def iterate(self, shuffleShards=False, seed=None):
+        """
+        Reads the captions sequentially, shard after shard, in the order in which they were written.
+
+        :param shuffleShards: if True, the shards are read in a random order (the captions of a shard are
+                              still read sequentially)
+        :param seed: seed of the shuffle
+        :return: generator yielding (captionID, sampleRate, samples)
+        """
+        shards = [row[0] for row in self._database.execute('SELECT DISTINCT shard FROM audioShards ORDER BY shard')]
+        if shuffleShards == True:
+            random.Random(seed).shuffle(shards)
+        for shard in shards:
+            data = self._shard(shard)
+            if hasattr(data, 'madvise') and hasattr(mmap, 'MADV_SEQUENTIAL'):
+                data.madvise(mmap.MADV_SEQUENTIAL)
+            rows = self._database.execute('SELECT captionID, offset, frames, sampleRate, channels, dtype '
+                                          'FROM audioShards WHERE shard=? ORDER BY offset', (shard,)).fetchall()
+            for captionID, offset, frames, sampleRate, channels, dtype in rows:
+                yield captionID, sampleRate, self._samples(shard, offset, frames, channels, dtype)
+
+    def close(self):
+        # the mappings themselves are released once the views of them are garbage collected
+        self._shards = dict()
+        self._database.close()
+
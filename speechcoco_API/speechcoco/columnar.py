@@ -0,0 +1,358 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import json
+import shutil
+import numpy as np
+
+from .speechcoco import Timecode
+
+'''
+    File name: columnar.py
+    Columnar (NumPy) export of the word, syllable and phoneme alignments of a SpeechCoco database.
+    Requires NumPy.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+#
+# CONSTANTS
+#
+
+# Levels
+WORD = 0
+SYLLABLE = 1
+PHONEME = 2
+
+# Arrays of an exported corpus: captionID and offsets have one entry per caption (offsets has one more), the
+# others one entry per element (word, syllable or phoneme) of the corpus. Elements are stored depth-first:
+# each word is followed by its syllables, each syllable by its phonemes. parent is the index of the parent
+# element within the caption (-1 for words) and label an index in the labels array.
+COLUMNS = [('captionID', np.int64),
+           ('offsets', np.int64),
+           ('level', np.int8),
+           ('parent', np.int32),
+           ('begin', np.float64),
+           ('end', np.float64),
+           ('label', np.int32)]
+
+
+#
+#   Flattening
+#
+
+def flatten(parsedTimecode):
+    """
+    Flattens the structure returned by Timecode.parse.
+
+    :param parsedTimecode:
+    :return: list of (level, parent, begin, end, value), depth-first
+    """
+    elements = []
+    for word in parsedTimecode:
+        wordIndex = len(elements)
+        elements.append((WORD, -1, word['begin'], word['end'], word['value']))
+        for syllable in word.get('syllable', []):
+            syllableIndex = len(elements)
+            elements.append((SYLLABLE, wordIndex, syllable['begin'], syllable['end'], syllable['value']))
+            for phoneme in syllable.get('phoneme', []):
+                elements.append((PHONEME, syllableIndex, phoneme['begin'], phoneme['end'], phoneme['value']))
+    return elements
+
+
+#
+#   Export
+#
+
+class _ColumnWriter(object):
+    # appends values to a raw file, turned into a .npy file once the number of values is known
+
+    def __init__(self, path, dtype, bufferSize=1 << 20):
+        self.path = path
+        self.dtype = np.dtype(dtype)
+        self.count = 0
+        self._buffer = []
+        self._bufferSize = bufferSize
+        self._raw = open(path + '.tmp', 'wb')
+
+    def extend(self, values):
+        self._buffer.extend(values)
+        if len(self._buffer) >= self._bufferSize:
+            self.flush()
+
+    def flush(self):
+        np.asarray(self._buffer, dtype=self.dtype).tofile(self._raw)
+        self.count += len(self._buffer)
+        self._buffer = []
+
+    def close(self):
+        self.flush()
+        self._raw.close()
+        with open(self.path, 'wb') as f:
+            np.lib.format.write_array_header_1_0(f, {'descr': np.lib.format.dtype_to_descr(self.dtype),
+                                                     'fortran_order': False, 'shape': (self.count,)})
+            with open(self.path + '.tmp', 'rb') as raw:
+                shutil.copyfileobj(raw, f)
+        os.remove(self.path + '.tmp')
+
+
+def exportAlignments(speechCoco, outputDir, seconds=True, verbose=False, **filters):
+    """
+    Writes the alignments of the captions selected by filters (see SpeechCoco.filterCaptions) as flat .npy
+    arrays (see COLUMNS), the labels (labels.npy) and the export settings (info.json). The captions are
+    streamed, so memory use doesn't depend on the size of the corpus.
+
+    :param speechCoco: SpeechCoco object
+    :param outputDir:
+    :param seconds: if True, times are in seconds, otherwise in milliseconds
+    :param verbose:
+    :param filters: filters accepted by SpeechCoco.filterCaptions
+    :return: number of captions exported
+    """
+    if not os.path.isdir(outputDir):
+        os.makedirs(outputDir)
+
+    writers = dict((name, _ColumnWriter(os.path.join(outputDir, name + '.npy'), dtype)) for name, dtype in COLUMNS)
+    writers['offsets'].extend([0])
+    labels = dict()
+    offset = 0
+    nbCaptions = 0
+
+    filters['raw'] = True
+    filters['stream'] = True
+    for row in speechCoco.filterCaptions(**filters):
+        elements = flatten(Timecode.s_parse(Timecode.load(row['timecode']), seconds=seconds))
+        offset += len(elements)
+        writers['captionID'].extend([row['captionID']])
+        writers['offsets'].extend([offset])
+        writers['level'].extend([e[0] for e in elements])
+        writers['parent'].extend([e[1] for e in elements])
+        writers['begin'].extend([e[2] for e in elements])
+        writers['end'].extend([e[3] for e in elements])
+        writers['label'].extend([labels.setdefault(e[4], len(labels)) for e in elements])
+        nbCaptions += 1
+        if verbose == True and nbCaptions % 10000 == 0:
+            print("\t{} captions".format(nbCaptions))
+
+    for writer in writers.values():
+        writer.close()
+    np.save(os.path.join(outputDir, 'labels.npy'), np.array(sorted(labels, key=labels.get), dtype=np.str_))
+    with open(os.path.join(outputDir, 'info.json'), 'w') as f:
+        json.dump({'seconds': seconds, 'captions': nbCaptions, 'elements': offset}, f)
+
+    if verbose == True:
+        print("|> {} captions, {} elements exported to {}".format(nbCaptions, offset, outputDir))
+    return nbCaptions
+
+
+#
+#   Reader
+#
+
+class AlignmentCorpus(object):
+    """
+    Reader of a corpus exported by exportAlignments. The arrays are memory-mapped (read-only) and the per-caption
+    arrays are views, so that the data is shared (through the page cache) by all the processes reading it.
+    When pickled (e.g. sent to a DataLoader worker), only the directory is sent and the arrays are mapped
+    again in the receiving process.
+    """
+
+    def __init__(self, directory, mmap=True):
+        self.directory = directory
+        self.mmap = mmap
+        self._open()
+
+    def _open(self):
+        mode = 'r' if self.mmap else None
+        for name, _ in COLUMNS:
+            setattr(self, name, np.load(os.path.join(self.directory, name + '.npy'), mmap_mode=mode))
+        self.labels = np.load(os.path.join(self.directory, 'labels.npy'), mmap_mode=mode)
+        with open(os.path.join(self.directory, 'info.json')) as f:
+            self.info = json.load(f)
+        self._positions = None
+
+    @classmethod
+    def fromParsed(cls, parsedTimecodes, captionIDs=None):
+        """
+        Builds an in-memory corpus from parsed timecodes (see Timecode.parse).
+
+        :param parsedTimecodes: list of parsed timecodes
+        :param captionIDs: captionIDs of the timecodes (defaults to their index)
+        :return: AlignmentCorpus
+        """
+        corpus = cls.__new__(cls)
+        corpus.directory = None
+        corpus.mmap = False
+        corpus.info = {}
+        labels = dict()
+        columns = dict((name, []) for name, _ in COLUMNS)
+        columns['offsets'].append(0)
+        for parsedTimecode in parsedTimecodes:
+            elements = flatten(parsedTimecode)
+            columns['offsets'].append(columns['offsets'][-1] + len(elements))
+            for level, parent, begin, end, value in elements:
+                columns['level'].append(level)
+                columns['parent'].append(parent)
+                columns['begin'].append(begin)
+                columns['end'].append(end)
+                columns['label'].append(labels.setdefault(value, len(labels)))
+        columns['captionID'] = captionIDs if captionIDs is not None else range(len(parsedTimecodes))
+        for name, dtype in COLUMNS:
+            setattr(corpus, name, np.asarray(columns[name], dtype=dtype))
+        corpus.labels = np.array(sorted(labels, key=labels.get), dtype=np.str_)
+        corpus._positions = None
+        return corpus
+
+    def __getstate__(self):
+        if self.directory is None:
+            return self.__dict__
+        return {'directory': self.directory, 'mmap': self.mmap}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        if 'level' not in state:
+            self._open()
+
+    def __len__(self):
+        return len(self.captionID)
+
+    def __getitem__(self, index):
+        """
+        :param index: index of the caption in the corpus
+        :return: dict of views on the arrays of the caption (level, parent, begin, end, label)
+        """
+        begin, end = self.offsets[index], self.offsets[index + 1]
+        return {'captionID': int(self.captionID[index]), 'level': self.level[begin:end],
+                'parent': self.parent[begin:end], 'begin': self.begin[begin:end], 'end': self.end[begin:end],
+                'label': self.label[begin:end]}
+
+    def index(self, captionID):
+        """
+        :param captionID:
+        :return: index of the caption in the corpus
+        """
+        if self._positions is None:
+            self._positions = np.argsort(self.captionID, kind='mergesort')
+        position = np.searchsorted(self.captionID, captionID, sorter=self._positions)
+        if position == len(self._positions) or self.captionID[self._positions[position]] != captionID:
+            raise KeyError(captionID)
+        return int(self._positions[position])
+
+    def caption(self, captionID):
+        """
+        :param captionID:
+        :return: same as __getitem__, looked up by captionID
+        """
+        return self[self.index(captionID)]
+
+    def toParsed(self, index):
+        """
+        Rebuilds the structure returned by Timecode.parse for a caption of the corpus.
+
+        :param index: index of the caption in the corpus
+        :return:
+        """
+        caption = self[index]
+        elements = []
+        words = []
+        for level, parent, begin, end, label in zip(caption['level'].tolist(), caption['parent'].tolist(),
+                                                    caption['begin'].tolist(), caption['end'].tolist(),
+                                                    caption['label'].tolist()):
+            element = {'value': str(self.labels[label]), 'begin': begin, 'end': end}
+            elements.append(element)
+            if level == WORD:
+                words.append(element)
+            else:
+                key = 'syllable' if level == SYLLABLE else 'phoneme'
+                elements[parent].setdefault(key, []).append(element)
+        return words
+
+
+#
+#   Batch queries
+#
+
+def getWordsBatch(corpus, windows, level=1, olapthr=75, asArrays=False, chunkSize=100000):
+    """
+    Vectorized version of Caption.s_getWords for many (caption, window) pairs at once. The overlaps are computed
+    with the same floating point operations, hence the results are identical.
+
+    :param corpus: AlignmentCorpus, or list of parsed timecodes (see Timecode.parse)
+    :param windows: sequence of (caption index in the corpus, begin, end), in the same unit as the corpus
+    :param level: 1 -> words, 2 -> words and syllables, 3 -> words, syllables and phonemes
+    :param olapthr: minimum overlap percentage of the words
+    :param asArrays: if True, returns arrays instead of the dicts of s_getWords
+    :param chunkSize: number of windows processed at a time (bounds memory use)
+    :return: if asArrays is False, list with the result of s_getWords for each window
+             if asArrays is True, dict of arrays with one entry per selected element: window (index of the
+             window), element (index of the element in the corpus), level and overlap
+    """
+    if not isinstance(corpus, AlignmentCorpus):
+        corpus = AlignmentCorpus.fromParsed(corpus)
+    if level < 1:
+        level = 3
+
+    windows = np.asarray(windows, dtype=np.float64).reshape(-1, 3)
+    arrays = []
+    for start in range(0, len(windows), chunkSize):
+        selected = _selectElements(corpus, windows[start:start + chunkSize], level, olapthr)
+        selected['window'] += start
+        arrays.append(selected)
+    if len(arrays) == 0:
+        arrays.append(_selectElements(corpus, windows, level, olapthr))
+    arrays = dict((key, np.concatenate([a[key] for a in arrays])) for key in arrays[0])
+
+    if asArrays == True:
+        return arrays
+
+    labels = corpus.labels.tolist()
+    element = arrays['element']
+    results = [[] for _ in range(len(windows))]
+    for window, elementLevel, label, overlap, begin, end in zip(arrays['window'].tolist(), arrays['level'].tolist(),
+                                                                 corpus.label[element].tolist(),
+                                                                 arrays['overlap'].tolist(),
+                                                                 corpus.begin[element].tolist(),
+                                                                 corpus.end[element].tolist()):
+        tokens = results[window]
+        value = labels[label]
+        if elementLevel == WORD:
+            tokens.append({'word': value.lower(), 'overlapPercentage': overlap, 'begin': begin, 'end': end})
+        elif elementLevel == SYLLABLE:
+            tokens[-1].setdefault('syllables', []).append({'value': value, 'overlapPercentage': overlap,
+                                                           'begin': begin, 'end': end})
+        else:
+            tokens[-1]['syllables'][-1].setdefault('phonemes', []).append({'value': value, 'overlapPercentage': overlap,
+                                                                           'begin': begin, 'end': end})
+    return results
+
+
+def _selectElements(corpus, windows, level, olapthr):
+    # one pair per (window, element of the window's caption); elements of a caption are contiguous, hence the
+    # pair of an element's parent is found by subtracting the distance between the element and its parent
+    captions = windows[:, 0].astype(np.int64)
+    starts = np.asarray(corpus.offsets[captions])
+    counts = np.asarray(corpus.offsets[captions + 1]) - starts
+    pairWindow = np.repeat(np.arange(len(windows)), counts)
+    firstPair = np.repeat(np.cumsum(counts) - counts, counts)
+    relative = np.arange(len(pairWindow)) - firstPair
+    element = np.repeat(starts, counts) + relative
+
+    begin, end = windows[pairWindow, 1], windows[pairWindow, 2]
+    goldBegin, goldEnd = np.asarray(corpus.begin[element]), np.asarray(corpus.end[element])
+    elementLevel = np.asarray(corpus.level[element])
+    parentPair = firstPair + np.asarray(corpus.parent[element])
+
+    intersects = (begin <= goldEnd) & (end >= goldBegin)
+    overlap = np.maximum(0, np.minimum(end, goldEnd) - np.maximum(begin, goldBegin)) / (goldEnd - goldBegin) * 100
+
+    selected = (elementLevel == WORD) & intersects & (overlap >= olapthr)
+    for lowerLevel in (SYLLABLE, PHONEME)[:level - 1]:
+        isLevel = elementLevel == lowerLevel
+        selected[isLevel] = intersects[isLevel] & selected[parentPair[isLevel]]
+
+    return {'window': pairWindow[selected], 'element': element[selected], 'level': elementLevel[selected],
+            'overlap': overlap[selected]}
+
@@ -0,0 +1,334 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import json
+import time
+import sqlite3
+import hashlib
+import functools
+import numpy as np
+
+from .speechcoco import _mapFiles
+from .audio import WavFile
+
+'''
+    File name: features.py
+    Log-mel and MFCC features of the captions of SpeechCoco, computed once and stored in memory-mapped files.
+    Requires NumPy.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+#
+# CONSTANTS
+#
+
+# Feature types
+LOGMEL = 'logmel'
+MFCC = 'mfcc'
+
+# Default extraction parameters (window and hop lengths in seconds)
+FEATURE_PARAMS = {'type': MFCC,
+                  'winLength': 0.025,
+                  'hopLength': 0.010,
+                  'nFFT': 512,
+                  'nMels': 40,
+                  'nMFCC': 13,
+                  'fMin': 0.0,
+                  'fMax': None,
+                  'preemphasis': 0.97}
+
+# Name of the index of a feature store
+INDEX_FILENAME = 'features.sqlite3'
+
+
+#
+#   Feature extraction
+#
+
+def toFloat(samples):
+    """
+    :param samples: samples (see audio.WavFile.samples)
+    :return: mono float64 samples in [-1, 1]
+    """
+    samples = np.asarray(samples)
+    if samples.dtype.kind == 'u':
+        samples = (samples.astype(np.float64) - 128) / 128.0
+    elif samples.dtype.kind == 'i':
+        samples = samples.astype(np.float64) / float(2 ** (8 * samples.dtype.itemsize - 1))
+    else:
+        samples = samples.astype(np.float64)
+    if samples.ndim > 1:
+        samples = samples.mean(axis=1)
+    return samples
+
+
+def melFilterbank(sampleRate, nFFT, nMels, fMin=0.0, fMax=None):
+    """
+    :return: (nMels, nFFT // 2 + 1) matrix of triangular filters equally spaced on the mel scale
+    """
+    if fMax is None:
+        fMax = sampleRate / 2.0
+    toMel = lambda f: 2595.0 * np.log10(1.0 + f / 700.0)
+    toHertz = lambda m: 700.0 * (10 ** (m / 2595.0) - 1.0)
+    bins = np.floor((nFFT + 1) * toHertz(np.linspace(toMel(fMin), toMel(fMax), nMels + 2)) / sampleRate).astype(int)
+
+    filterbank = np.zeros((nMels, nFFT // 2 + 1))
+    for i in range(nMels):
+        left, center, right = bins[i], bins[i + 1], bins[i + 2]
+        if center > left:
+            filterbank[i, left:center] = (np.arange(left, center) - left) / float(center - left)
+        if right > center:
+            filterbank[i, center:right] = (right - np.arange(center, right)) / float(right - center)
+    return filterbank
+
+
+def logMel(samples, sampleRate, winLength=0.025, hopLength=0.010, nFFT=512, nMels=40, fMin=0.0, fMax=None,
+           preemphasis=0.97):
+    """
+    :param samples: samples (see toFloat)
+    :param sampleRate:
+    :param winLength: window length (seconds)
+    :param hopLength: hop length (seconds)
+    :return: (frames, nMels) log-mel energies. Frame t covers [t * hopLength, t * hopLength + winLength]
+    """
+    signal = toFloat(samples)
+    if preemphasis:
+        signal = np.append(signal[:1], signal[1:] - preemphasis * signal[:-1])
+    winSize = int(round(winLength * sampleRate))
+    hopSize = int(round(hopLength * sampleRate))
+    if len(signal) < winSize:
+        signal = np.pad(signal, (0, winSize - len(signal)), 'constant')
+    nbFrames = 1 + (len(signal) - winSize) // hopSize
+    frames = signal[np.arange(winSize)[None, :] + hopSize * np.arange(nbFrames)[:, None]] * np.hamming(winSize)
+    power = np.abs(np.fft.rfft(frames, nFFT)) ** 2 / nFFT
+    energies = power.dot(melFilterbank(sampleRate, nFFT, nMels, fMin, fMax).T)
+    return np.log(np.maximum(energies, 1e-10))
+
+
+def mfcc(samples, sampleRate, nMFCC=13, **kwargs):
+    """
+    :param samples: samples (see toFloat)
+    :param sampleRate:
+    :param nMFCC: number of coefficients kept
+    :param kwargs: parameters of logMel
+    :return: (frames, nMFCC) MFCCs (orthonormal DCT-II of the log-mel energies)
+    """
+    energies = logMel(samples, sampleRate, **kwargs)
+    nMels = energies.shape[1]
+    basis = np.cos(np.pi / nMels * (np.arange(nMels) + 0.5)[None, :] * np.arange(nMFCC)[:, None])
+    basis *= np.sqrt(2.0 / nMels)
+    basis[0] /= np.sqrt(2.0)
+    return energies.dot(basis.T)
+
+
+def computeFeatures(samples, sampleRate, params=None):
+    """
+    :param samples:
+    :param sampleRate:
+    :param params: extraction parameters (see FEATURE_PARAMS), missing ones take their default value
+    :return: (frames, dimension) float32 features
+    """
+    params = _completeParams(params)
+    kwargs = dict((key, params[key]) for key in ('winLength', 'hopLength', 'nFFT', 'nMels', 'fMin', 'fMax',
+                                                 'preemphasis'))
+    if params['type'] == LOGMEL:
+        features = logMel(samples, sampleRate, **kwargs)
+    elif params['type'] == MFCC:
+        features = mfcc(samples, sampleRate, nMFCC=params['nMFCC'], **kwargs)
+    else:
+        raise ValueError("Unknown feature type {}".format(params['type']))
+    return features.astype(np.float32)
+
+
+def _completeParams(params):
+    completed = dict(FEATURE_PARAMS)
+    completed.update(params or {})
+    return completed
+
+
+def _paramsKey(params):
+    return hashlib.sha1(json.dumps(params, sort_keys=True).encode('utf-8')).hexdigest()[:16]
+
+
+#
+#   Feature store
+#
+
+def extractFeatures(speechCoco, directory, params=None, workers=None, shardStore=None, verbose=False, **filters):
+    """
+    Computes the features of the captions selected by filters (see SpeechCoco.filterCaptions) in a pool of
+    processes and appends them to the feature store in directory (see FeatureStore). Captions whose features
+    were already computed with the same parameters are skipped, hence changing the parameters only computes
+    the features for the new parameters, and an interrupted extraction resumes where it stopped.
+
+    :param speechCoco: SpeechCoco object (the audio is read from its wavDir, unless shardStore is given)
+    :param directory: directory of the feature store
+    :param params: extraction parameters (see FEATURE_PARAMS)
+    :param workers: number of processes (defaults to the number of CPUs)
+    :param shardStore: audio.ShardStore the audio is read from
+    :param verbose:
+    :param filters: filters accepted by SpeechCoco.filterCaptions
+    :return: dict with the number of captions computed and skipped and the time spent
+    """
+    store = FeatureStore(directory, params)
+    if shardStore is None:
+        assert speechCoco._wavDir != '', "|> No WAV directory given!"
+
+    filters['raw'] = True
+    filters['stream'] = True
+    report = {'computed': 0, 'skipped': 0}
+    items = []
+    for row in speechCoco.filterCaptions(**filters):
+        if row['captionID'] in store:
+            report['skipped'] += 1
+        elif shardStore is None:
+            items.append((row['captionID'], os.path.join(speechCoco._wavDir, row['wavFilename'])))
+        else:
+            items.append((row['captionID'], None))
+
+    if verbose == True:
+        print("|> Computing {} features of {} captions ({} already computed) ...".format(
+            store.params['type'], len(items), report['skipped']))
+    startTime = time.time()
+    compute = functools.partial(_computeCaptionFeatures, params=store.params, shardStore=shardStore)
+    batch = []
+    try:
+        for captionID, features in _mapFiles(compute, items, workers, chunksize=16):
+            batch.append((captionID, features))
+            if len(batch) >= 1000:
+                store._append(batch)
+                report['computed'] += len(batch)
+                batch = []
+                if verbose == True:
+                    print("\t{} / {} captions".format(report['computed'], len(items)))
+    finally:
+        store._append(batch)
+        report['computed'] += len(batch)
+        store.close()
+    report['seconds'] = time.time() - startTime
+
+    if verbose == True:
+        print("|> {computed} captions computed in {seconds:0.2f}s".format(**report))
+    return report
+
+
+def _computeCaptionFeatures(item, params, shardStore=None):
+    # module level so that it can be sent to worker processes
+    captionID, path = item
+    if shardStore is None:
+        with WavFile(path) as wavFile:
+            return captionID, computeFeatures(wavFile.samples(), wavFile.sampleRate, params)
+    return captionID, computeFeatures(shardStore.getSamples(captionID), shardStore.getSampleRate(captionID), params)
+
+
+class FeatureStore(object):
+    """
+    Features of the captions computed with a given set of parameters. The features of all the captions are
+    concatenated in one float32 file per set of parameters (<key>.f32), memory-mapped when read, and indexed
+    by captionID in features.sqlite3 (featureSets and features tables). Lookups never touch the audio.
+    When pickled, only the directory and parameters are sent.
+    """
+
+    def __init__(self, directory, params=None):
+        self.directory = directory
+        self.params = _completeParams(params)
+        self._open()
+
+    def _open(self):
+        if not os.path.isdir(self.directory):
+            os.makedirs(self.directory)
+        self.key = _paramsKey(self.params)
+        self.path = os.path.join(self.directory, self.key + '.f32')
+        self._index = sqlite3.connect(os.path.join(self.directory, INDEX_FILENAME))
+        self._index.execute('CREATE TABLE IF NOT EXISTS featureSets (key TEXT PRIMARY KEY, params TEXT, '
+                            'dimension INTEGER)')
+        self._index.execute('CREATE TABLE IF NOT EXISTS features (key TEXT, captionID INTEGER, offset INTEGER, '
+                            'frames INTEGER, PRIMARY KEY (key, captionID))')
+        self._index.commit()
+        row = self._index.execute('SELECT dimension FROM featureSets WHERE key=?', (self.key,)).fetchone()
+        self.dimension = row[0] if row is not None else None
+        self._data = None
+
+    def __getstate__(self):
+        return {'directory': self.directory, 'params': self.params}
+
+    def __setstate__(self, state):
+        self.__dict__.update(state)
+        self._open()
+
+    def __len__(self):
+        return self._index.execute('SELECT COUNT(*) FROM features WHERE key=?', (self.key,)).fetchone()[0]
+
+    def __contains__(self, captionID):
+        return self._index.execute('SELECT 1 FROM features WHERE key=? AND captionID=?',
+                                   (self.key, captionID)).fetchone() is not None
+
+    def featureSets(self):
+        """
+        :return: parameters of every set of features in the store
+        """
+        return [json.loads(params) for (params,) in self._index.execute('SELECT params FROM featureSets')]
+
+    def get(self, captionID):
+        """
+        :param captionID:
+        :return: (frames, dimension) read-only view of the features of the caption
+        """
+        row = self._index.execute('SELECT offset, frames FROM features WHERE key=? AND captionID=?',
+                                  (self.key, captionID)).fetchone()
+        if row is None:
+            raise KeyError(captionID)
+        offset, frames = row
+        if self._data is None or offset + frames > len(self._data):
+            # (re)maps the file, which may have grown since it was last mapped. Only whole frames are mapped: an
+            # interrupted write may have left a partial one at the end of the file.
+            self._data = np.memmap(self.path, dtype=np.float32, mode='r',
+                                   shape=(os.path.getsize(self.path) // (4 * self.dimension), self.dimension))
+        return self._data[offset:offset + frames]
+
+    def getSpan(self, captionID, begin, end, seconds=True):
+        """
+        Features of the frames of a caption starting between begin and end, e.g. the span of a word given by
+        Caption.getWords or SpeechCoco.findWordOccurrences.
+
+        :param captionID:
+        :param begin:
+        :param end:
+        :param seconds: True if begin and end are in seconds, False if in milliseconds
+        :return: read-only view of the features
+        """
+        if seconds == False:
+            begin, end = begin / 1000.0, end / 1000.0
+        hopLength = self.params['hopLength']
+        features = self.get(captionID)
+        return features[max(int(round(begin / hopLength)), 0):max(int(round(end / hopLength)), 0)]
+
+    def _append(self, batch):
+        # appends the (captionID, features) of batch to the file, then indexes them
+        if len(batch) == 0:
+            return
+        if self.dimension is None:
+            self.dimension = batch[0][1].shape[1]
+            self._index.execute('INSERT INTO featureSets VALUES (?,?,?)',
+                                (self.key, json.dumps(self.params, sort_keys=True), self.dimension))
+        rows = []
+        # data written after the last indexed features (e.g. by an interrupted run) is discarded
+        (offset,) = self._index.execute('SELECT COALESCE(MAX(offset + frames), 0) FROM features WHERE key=?',
+                                        (self.key,)).fetchone()
+        self._data = None
+        with open(self.path, 'ab') as f:
+            f.truncate(offset * 4 * self.dimension)
+            for captionID, features in batch:
+                features.astype(np.float32).tofile(f)
+                rows.append((self.key, captionID, offset, len(features)))
+                offset += len(features)
+        with self._index:
+            self._index.executemany('INSERT OR REPLACE INTO features VALUES (?,?,?,?)', rows)
+
+    def close(self):
+        self._data = None
+        self._index.close()
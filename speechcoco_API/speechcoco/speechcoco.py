@@ -4,10 +4,22 @@
 import os
 import time
 import json
+import base64
+import struct
+import bisect
 import shutil
 import weakref
 import sqlite3
+import threading
+import functools
+import itertools
+import multiprocessing
 from pprint import pprint
+from collections import OrderedDict
+try:
+    from urllib.request import pathname2url
+except ImportError:
+    from urllib import pathname2url
 
 '''
     File name: speechcoco.py
@@ -42,12 +54,63 @@ MD = 'Middle'
 END = 'End'
 BG_MD_END = ['Beginning', 'Middle', 'End']
 
+# Number of rows pulled from SQLite at a time when streaming results
+FETCH_SIZE = 1000
+
+# Lists of IDs are looked up by chunks of IN_CHUNK_SIZE values, below SQLite's limit on the number of bound
+# parameters (999 in older versions)
+IN_CHUNK_SIZE = 500
+
+# Secondary indexes of the captions table (name, columns). The composite indexes are ordered so that their
+# prefixes serve the usual filterCaptions combinations (speaker ; speaker + speed ; speed + disfluency, etc.)
+INDEXES = [('captions_imageID', 'captions', ['imageID']),
+           ('captions_speaker_speed_disfluencyPos', 'captions', ['speaker', 'speed', 'disfluencyPos']),
+           ('captions_speed_disfluencyPos', 'captions', ['speed', 'disfluencyPos']),
+           ('captions_disfluencyPos', 'captions', ['disfluencyPos']),
+           ('captions_duration', 'captions', ['duration']),
+           ('wordIndex_word_speed', 'wordIndex', ['word', 'speed']),
+           ('wordIndex_captionID', 'wordIndex', ['captionID']),
+           # occurrences of a word in (captionID, position) order: pages of findWordOccurrences seek in it
+           ('wordIndex_word_captionID_position', 'wordIndex', ['word', 'captionID', 'position']),
+           ('words_captionID', 'words', ['captionID', 'position']),
+           ('words_value', 'words', ['value']),
+           ('syllables_captionID', 'syllables', ['captionID', 'position']),
+           ('syllables_value', 'syllables', ['value']),
+           ('phonemes_captionID', 'phonemes', ['captionID', 'position']),
+           ('phonemes_value', 'phonemes', ['value'])]
+
+# Binary timecode format (see Timecode.encode): categories are stored as their index in TIMECODE_CATEGORIES
+TIMECODE_MAGIC = b'SCT1'
+TIMECODE_CATEGORIES = ['WORD', 'SYL', 'PHO', 'SIL', 'SEPR']
+# Types of the BLOBs read from SQLite (buffer in Python 2, bytes in Python 3)
+BINARY_TYPES = (bytes, bytearray, memoryview, type(sqlite3.Binary(b'')))
+
+# Tables storing the parsed timecodes (see SpeechCoco.buildAlignmentTables)
+ALIGNMENT_TABLES = ['words', 'syllables', 'phonemes']
+
+# Text search modes of filterCaptions. 'like' uses SQL LIKE patterns, the others use the FTS5 index
+LIKE = 'like'
+WORD = 'word'
+PREFIX = 'prefix'
+PHRASE = 'phrase'
+MATCH = 'match'
+
+# Corpus statistics (see SpeechCoco.buildStats): width (seconds) of the duration histogram bins and columns
+# the statistics can be grouped by
+STATS_BIN_WIDTH = 0.5
+STATS_GROUPS = ['speaker', 'gender', 'nationality', 'speed', 'disfluencyPos', 'durationBin']
+
+# Keyset pagination compares (imageID, captionID) pairs with row values, supported since SQLite 3.15
+ROW_VALUES = sqlite3.sqlite_version_info >= (3, 15, 0)
+
 
 #
 #   Timecode Class
 #
 
-class Timecode:
+class Timecode(object):
+    __slots__ = ('value', '_parent')
+
     def __init__(self, parent, timecode):
         self.value = timecode
         self._parent = weakref.ref(parent)
@@ -60,6 +123,15 @@ class Timecode:
         """
         return Timecode.s_parse(self.value, seconds=seconds)
 
+    def _parseCached(self, seconds=False):
+        # parsed timecode shared with the other callers if the caption comes from a SpeechCoco object (see
+        # SpeechCoco.cacheInfo), hence only used by the methods that don't modify it (getWords, toTextgrid)
+        caption = self._parent()
+        if caption is not None and caption._cache is not None:
+            return caption._cache.get((caption.captionID, seconds),
+                                      lambda: Timecode.s_parse(self.value, seconds=seconds))
+        return self.parse(seconds=seconds)
+
     def toTextgrid(self, output, level=3):
         """
 
@@ -67,7 +139,8 @@ class Timecode:
         :param level:
         :return:
         """
-        Timecode.s_toTextgrid(self.value, output, self._parent().filename, level)
+        Timecode.s_toTextgrid(self.value, output, self._parent().filename, level,
+                              parsedTimecodes=self._parseCached(seconds=True))
 
     @staticmethod
     def _milliToSec(t):
@@ -99,6 +172,73 @@ class Timecode:
             updatedTimecode.append([t, cat, value])
         return updatedTimecode
 
+    @staticmethod
+    def load(value):
+        """
+        Decodes the timecode column of the captions table, either JSON text or binary (see encode).
+
+        :param value:
+        :return: list of [time, category, value]
+        """
+        if isinstance(value, BINARY_TYPES) and bytes(value[:4]) == TIMECODE_MAGIC:
+            return Timecode.decode(value)
+        return json.loads(value)
+
+    @staticmethod
+    def encode(timecode):
+        """
+        Binary encoding of a timecode: magic, number of elements and of labels, then the times (float64), the
+        category codes (uint8), the label ids (uint16), all little-endian, and the interned labels (UTF-8,
+        NUL-separated).
+
+        :param timecode: list of [time, category, value]
+        :return: bytes, or None if the timecode can't be encoded (unknown category or too many labels)
+        """
+        labels = OrderedDict()
+        categories = bytearray()
+        labelIds = []
+        for element in timecode:
+            if element[1] not in TIMECODE_CATEGORIES or '\x00' in element[2]:
+                return None
+            categories.append(TIMECODE_CATEGORIES.index(element[1]))
+            labelIds.append(labels.setdefault(element[2], len(labels)))
+            if len(labels) > 0xFFFF:
+                return None
+        return b''.join([TIMECODE_MAGIC, struct.pack('<IH', len(timecode), len(labels)),
+                         struct.pack('<%dd' % len(timecode), *[element[0] for element in timecode]),
+                         bytes(categories), struct.pack('<%dH' % len(timecode), *labelIds),
+                         '\x00'.join(labels).encode('utf-8')])
+
+    @staticmethod
+    def decodeArrays(blob):
+        """
+        Decodes a binary timecode (see encode) into arrays.
+
+        :param blob:
+        :return: times (tuple of floats), category codes (bytearray), label ids (tuple of ints), labels (list)
+        """
+        blob = bytes(blob)
+        n, nbLabels = struct.unpack_from('<IH', blob, 4)
+        offset = 10
+        times = struct.unpack_from('<%dd' % n, blob, offset)
+        offset += 8 * n
+        categories = bytearray(blob[offset:offset + n])
+        offset += n
+        labelIds = struct.unpack_from('<%dH' % n, blob, offset)
+        labels = blob[offset + 2 * n:].decode('utf-8').split('\x00') if nbLabels != 0 else []
+        return times, categories, labelIds, labels
+
+    @staticmethod
+    def decode(blob):
+        """
+        Decodes a binary timecode (see encode).
+
+        :param blob:
+        :return: list of [time, category, value]
+        """
+        times, categories, labelIds, labels = Timecode.decodeArrays(blob)
+        return [[t, TIMECODE_CATEGORIES[c], labels[l]] for t, c, l in zip(times, categories, labelIds)]
+
     @staticmethod
     def s_parse(timecode, seconds=False):
         """
@@ -167,18 +307,27 @@ class Timecode:
         if len(wordAlignment[-1]) < 3:
             wordAlignment[-1].update({"end": syllableAlignment[-1]["begin"]})
 
+        # the timecodes are ordered in time, hence the syllables (resp. phonemes) belonging to a word
+        # (resp. syllable) form a contiguous run that is found by bisection instead of a full scan
+        syllableBegins = [s['begin'] for s in syllableAlignment]
+        phonemeBegins = [p['begin'] for p in phonemeAlignment]
+        syllableSorted = Timecode._isSorted(syllableAlignment, syllableBegins)
+        phonemeSorted = Timecode._isSorted(phonemeAlignment, phonemeBegins)
+
         # add syllable and phoneme to each word
         for wordTimecode in wordAlignment:
             alignment.append(wordTimecode)
             wordBegin = wordTimecode["begin"]
             wordEnd = wordTimecode["end"]
             # look for the syllables belonging to the word
-            for syllableTimecode in syllableAlignment:
+            for syllableTimecode in Timecode._candidates(syllableAlignment, syllableBegins, syllableSorted,
+                                                         wordBegin, wordEnd):
                 syllableBegin = syllableTimecode["begin"]
                 syllableEnd = syllableTimecode["end"]
                 if syllableBegin >= wordBegin and syllableEnd <= wordEnd:
                     # look for the phoneme belonging to the syllable
-                    for phonemeTimecode in phonemeAlignment:
+                    for phonemeTimecode in Timecode._candidates(phonemeAlignment, phonemeBegins, phonemeSorted,
+                                                                syllableBegin, syllableEnd):
                         phonemeBegin = phonemeTimecode["begin"]
                         phonemeEnd = phonemeTimecode["end"]
                         if phonemeBegin >= syllableBegin and phonemeEnd <= syllableEnd:
@@ -202,13 +351,28 @@ class Timecode:
         return alignment
 
     @staticmethod
-    def s_toTextgrid(timecodes, outputDir, wavName, level=3):
+    def _isSorted(elements, begins):
+        # True if the elements are ordered in time and none of them ends before it begins
+        return all(begins[i] <= begins[i + 1] for i in range(len(begins) - 1)) and \
+               all(element['begin'] <= element['end'] for element in elements)
+
+    @staticmethod
+    def _candidates(elements, begins, isSorted, begin, end):
+        # elements whose begin time lies within [begin, end], the only ones that may be included in [begin, end]
+        # (falls back to all the elements if the timecode is not ordered in time)
+        if not isSorted:
+            return elements
+        return elements[bisect.bisect_left(begins, begin):bisect.bisect_right(begins, end)]
+
+    @staticmethod
+    def s_toTextgrid(timecodes, outputDir, wavName, level=3, parsedTimecodes=None):
         """
         :param timecodes (dict): dict containing the timecodes
         :param level (int): 1 -> word level
                             2 -> syllable level
                             3 -> phoneme level.
                             Levels are cumulative, i.e. 3 includes 1 and 2 ; 2 includes 1
+        :param parsedTimecodes: timecodes already parsed (in seconds), if available
         :return: void
         """
 
@@ -226,83 +390,193 @@ class Timecode:
                 filename = 'TextGridFile.TextGrid'
             outputDir = os.path.split(outputDir)[0] + '/' + filename
 
-        timecodes = Timecode.s_parse(timecodes, seconds=True)
+        if parsedTimecodes is None:
+            timecodes = Timecode.s_parse(timecodes, seconds=True)
+        else:
+            timecodes = parsedTimecodes
 
         with open(outputDir, 'w') as f:
-            if level < 1:
-                level = 3
-
-            # "header" of the TextGrid file
-            f.write("File type = \"ooTextFile\"\n")
-            f.write("Object class = \"TextGrid\"\n\n")
-            f.write("xmin = 0\n")
-            f.write("xmax = " + str(timecodes[-1]["end"]) + "\n")
-            f.write("tiers? <exists>\n")
-            f.write("size = " + str(level) + "\n")
-            f.write("item[]:\n")
-
-            # level count
-            levelNumber = 1
-
-            # phoneme level
-            if level >= 3:
-                # get phonemes
-                phonemes = [phoneme for words in timecodes for syllables in words["syllable"] for phoneme in
-                            syllables["phoneme"]]
-                nbTier = len(phonemes)
-                f.write("\titem[" + str(levelNumber) + "]:\n")
-                f.write("\t\tclass = \"IntervalTier\"\n")
-                f.write("\t\tname = \"phonemes\"\n")
-                f.write("\t\txmin = 0\n")
-                f.write("\t\txmax = " + str(phonemes[-1]["end"]) + "\n")
-                f.write("\t\tintervals: size = " + str(nbTier) + "\n")
-                for i in range(nbTier):
-                    f.write("\t\tintervals [" + str(i + 1) + "]:\n")
-                    f.write("\t\t\txmin = " + str(phonemes[i]['begin']) + "\n")
-                    f.write("\t\t\txmax = " + str(phonemes[i]['end']) + "\n")
-                    f.write("\t\t\ttext = \"" + str(phonemes[i]['value']) + "\"\n")
-                levelNumber += 1
-
-            # syllable level
-            if level >= 2:
-                # get syllables
-                syllables = [syllable for word in timecodes for syllable in word["syllable"]]
-                nbTier = len(syllables)
-                f.write("\titem[" + str(levelNumber) + "]:\n")
-                f.write("\t\tclass = \"IntervalTier\"\n")
-                f.write("\t\tname = \"syllables\"\n")
-                f.write("\t\txmin = 0\n")
-                f.write("\t\txmax = " + str(syllables[-1]["end"]) + "\n")
-                f.write("\t\tintervals: size = " + str(nbTier) + "\n")
-                for i in range(nbTier):
-                    f.write("\t\tintervals [" + str(i + 1) + "]:\n")
-                    f.write("\t\t\txmin = " + str(syllables[i]['begin']) + "\n")
-                    f.write("\t\t\txmax = " + str(syllables[i]['end']) + "\n")
-                    f.write("\t\t\ttext = \"" + str(syllables[i]['value']) + "\"\n")
-                levelNumber += 1
+            f.write(Timecode.s_renderTextgrid(timecodes, level))
 
-            # word level
-            if level >= 1:
-                nbTier = len(timecodes)
-                f.write("\titem[" + str(levelNumber) + "]:\n")
-                f.write("\t\tclass = \"IntervalTier\"\n")
-                f.write("\t\tname = \"words\"\n")
-                f.write("\t\txmin = 0\n")
-                f.write("\t\txmax = " + str(timecodes[-1]["end"]) + "\n")
-                f.write("\t\tintervals: size = " + str(nbTier) + "\n")
-                for i in range(nbTier):
-                    f.write("\t\tintervals [" + str(i + 1) + "]:\n")
-                    f.write("\t\t\txmin = " + str(timecodes[i]['begin']) + "\n")
-                    f.write("\t\t\txmax = " + str(timecodes[i]['end']) + "\n")
-                    f.write("\t\t\ttext = \"" + str(timecodes[i]['value']) + "\"\n")
-                levelNumber += 1
+    @staticmethod
+    def s_renderTextgrid(timecodes, level=3):
+        """
+        :param timecodes: parsed timecodes (in seconds)
+        :param level (int): see s_toTextgrid
+        :return: content of the TextGrid file
+        """
+        if level < 1:
+            level = 3
+
+        # "header" of the TextGrid file
+        lines = ["File type = \"ooTextFile\"",
+                 "Object class = \"TextGrid\"",
+                 "",
+                 "xmin = 0",
+                 "xmax = " + str(timecodes[-1]["end"]),
+                 "tiers? <exists>",
+                 "size = " + str(level),
+                 "item[]:"]
+
+        # level count
+        levelNumber = 1
+
+        # phoneme level
+        if level >= 3:
+            phonemes = [phoneme for words in timecodes for syllables in words["syllable"] for phoneme in
+                        syllables["phoneme"]]
+            Timecode._renderTier(lines, levelNumber, "phonemes", phonemes)
+            levelNumber += 1
+
+        # syllable level
+        if level >= 2:
+            syllables = [syllable for word in timecodes for syllable in word["syllable"]]
+            Timecode._renderTier(lines, levelNumber, "syllables", syllables)
+            levelNumber += 1
+
+        # word level
+        if level >= 1:
+            Timecode._renderTier(lines, levelNumber, "words", timecodes)
+            levelNumber += 1
+
+        lines.append("")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _renderTier(lines, levelNumber, name, elements):
+        lines.extend(["\titem[" + str(levelNumber) + "]:",
+                      "\t\tclass = \"IntervalTier\"",
+                      "\t\tname = \"" + name + "\"",
+                      "\t\txmin = 0",
+                      "\t\txmax = " + str(elements[-1]["end"]),
+                      "\t\tintervals: size = " + str(len(elements))])
+        for i, element in enumerate(elements):
+            lines.extend(["\t\tintervals [" + str(i + 1) + "]:",
+                          "\t\t\txmin = " + str(element['begin']),
+                          "\t\t\txmax = " + str(element['end']),
+                          "\t\t\ttext = \"" + str(element['value']) + "\""])
+
+#
+#   Alignment cache
+#
+
+class AlignmentCache(object):
+    """
+    Bounded LRU cache of parsed timecodes, keyed by (captionID, seconds).
+    """
+
+    def __init__(self, maxSize=1024):
+        self.maxSize = maxSize
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, compute):
+        """
+
+        :param key:
+        :param compute: function called to compute the value on a miss
+        :return:
+        """
+        with self._lock:
+            if key in self._items:
+                self.hits += 1
+                value = self._items.pop(key)
+                self._items[key] = value
+                return value
+            self.misses += 1
+
+        value = compute()
+        with self._lock:
+            if self.maxSize > 0:
+                self._items[key] = value
+                while len(self._items) > self.maxSize:
+                    self._items.popitem(last=False)
+        return value
+
+    def clear(self):
+        with self._lock:
+            self._items.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        with self._lock:
+            return {'hits': self.hits, 'misses': self.misses, 'size': len(self._items), 'maxSize': self.maxSize}
+
+    def __len__(self):
+        return len(self._items)
+
+
+#
+# Page class
+#
+
+class Page(list):
+    """
+    One page of results of a listing method (see the pageSize and pageToken parameters). nextToken is the token
+    of the following page, None on the last page.
+    """
+
+    def __init__(self, items=(), nextToken=None):
+        super(Page, self).__init__(items)
+        self.nextToken = nextToken
+
+    @staticmethod
+    def encodeToken(key):
+        return base64.urlsafe_b64encode(json.dumps(key).encode('utf-8')).decode('ascii')
+
+    @staticmethod
+    def decodeToken(token, size):
+        try:
+            key = json.loads(base64.urlsafe_b64decode(token.encode('ascii')).decode('utf-8'))
+        except (ValueError, TypeError, AttributeError):
+            raise ValueError("Invalid page token {}".format(token))
+        if type(key) is not list or len(key) != size:
+            raise ValueError("Invalid page token {}".format(token))
+        return key
+
+
+#
+# Connections class
+#
+
+class ThreadConnections(object):
+    """
+    Connections of one thread of one process to the databases (see SpeechCoco._connections). They are closed when
+    the object is garbage collected, i.e. when the thread that owns it ends, or by close().
+    """
+
+    def __init__(self, database, translationDatabase=None):
+        self.pid = os.getpid()
+        self.database = database
+        self.cursor = database.cursor()
+        self.translationDatabase = translationDatabase
+        self.translationCursor = translationDatabase.cursor() if translationDatabase is not None else None
+        self.attached = False
+        self.closed = False
+
+    def __del__(self):
+        self.close()
+
+    def close(self):
+        # connections inherited from a parent process (fork) are left to it
+        if self.closed == True or self.pid != os.getpid():
+            return
+        self.closed = True
+        for database in [self.database, self.translationDatabase]:
+            if database is not None:
+                database.close()
 
 
 #
 # Speaker class
 #
 
-class Speaker:
+class Speaker(object):
+    __slots__ = ('name', 'gender', 'nationality')
+
     def __init__(self, info):
         self.name = info['name']
         self.gender = info['gender']
@@ -316,8 +590,11 @@ class Speaker:
 # Caption class
 #
 
-class Caption:
-    def __init__(self, speaker, info):
+class Caption(object):
+    __slots__ = ('speaker', 'captionID', 'imageID', 'text', 'disfluencyVal', 'disfluencyPos', 'duration', 'filename',
+                 'speed', 'translations', '_timecode', '_rawTimecode', '_cache', '_owner', '__weakref__')
+
+    def __init__(self, speaker, info, cache=None, owner=None):
         self.speaker = speaker
         self.captionID = info['captionID']
         self.imageID = info['imageID']
@@ -327,13 +604,62 @@ class Caption:
         self.duration = info['duration']
         self.filename = info['wavFilename']
         self.speed = info['speed']
-        self.timecode = Timecode(self, json.loads(info['timecode']))
+        # the timecode is only decoded when it is first accessed
+        self._rawTimecode = info['timecode']
+        self._timecode = None
+        # translations joined by filterCaptions (see the translations parameter)
+        self.translations = {}
+        # cache of parsed timecodes shared by the captions of a SpeechCoco object
+        self._cache = cache
+        # SpeechCoco object the caption comes from
+        self._owner = weakref.ref(owner) if owner is not None else None
 
     def __str__(self):
         return self.text
 
+    @property
+    def timecode(self):
+        if self._timecode is None:
+            self._timecode = Timecode(self, Timecode.load(self._rawTimecode))
+            self._rawTimecode = None
+        return self._timecode
+
+    def getAlignment(self, seconds=False):
+        """
+        Same structure as timecode.parse(), read from the alignment tables of the database when it has them
+        (see SpeechCoco.buildAlignmentTables) instead of parsing the timecode.
+
+        :param seconds:
+        :return:
+        """
+        owner = self._owner() if self._owner is not None else None
+        if owner is not None and owner.hasAlignmentTables():
+            alignment = owner._readAlignment(self.captionID, seconds=seconds)
+            if alignment is not None:
+                return alignment
+        return self.timecode.parse(seconds=seconds)
+
     def getWords(self, begin, end, seconds=True, level=1, olapthr=75):
-        return Caption.s_getWords(self.timecode.parse(seconds=seconds), begin, end, level, olapthr)
+        return Caption.s_getWords(self.timecode._parseCached(seconds=seconds), begin, end, level, olapthr)
+
+    def getSegmentAudio(self, begin, end, seconds=True, wavDir=None):
+        """
+        Samples of the caption's WAV file between begin and end, as a read-only NumPy view of the memory-mapped
+        file (see audio.WavFile). Requires NumPy.
+
+        :param begin:
+        :param end:
+        :param seconds: True if begin and end are in seconds, False if in milliseconds
+        :param wavDir: directory of the WAV files, defaults to the wavDir of the SpeechCoco object
+        :return:
+        """
+        from .audio import getSegment
+
+        if wavDir is None:
+            owner = self._owner() if self._owner is not None else None
+            assert owner is not None and owner._wavDir != '', "|> No WAV directory given!"
+            wavDir = owner._wavDir
+        return getSegment(os.path.join(wavDir, self.filename), begin, end, seconds)
 
     @staticmethod
     def s_getWords(parsedTimecode, begin, end, level=1, olapthr=75):
@@ -403,24 +729,40 @@ class SpeechCoco:
     #   __init__
     #
 
-    def __init__(self, databaseDir, translationDir='', verbose=False):
+    def __init__(self, databaseDir, translationDir='', verbose=False, cacheSize=1024, wavDir='', readOnly=False):
+        """
+        Connections to the databases are opened on first use by each thread and each process, hence a SpeechCoco
+        object can be shared by the threads of a pool or sent (pickled, or inherited through fork) to worker
+        processes. With readOnly, connections are opened in read-only mode: any number of readers can share the
+        database safely, but the methods writing to it (ensureIndexes, build*Index, etc.) fail.
+
+        :param databaseDir: caption database
+        :param translationDir: translation database
+        :param verbose:
+        :param cacheSize: maximum number of parsed timecodes kept in cache
+        :param wavDir: directory of the WAV files
+        :param readOnly: if True, the databases are opened in read-only mode
+        """
         assert os.path.splitext(databaseDir)[1] == ".sqlite3", "Incorrect file format!"
         assert os.stat(databaseDir), "The database doesn't exist!"
 
         if verbose == True:
             print("|> Loading the database {} ...".format(databaseDir))
 
-        self.database = sqlite3.connect(databaseDir)
-        self.database.row_factory = sqlite3.Row
-        self.cursor = self.database.cursor()
-        # self.cursor.execute("PRAGMA synchronous = OFF;")
-
+        self._databaseDir = databaseDir
+        self._readOnly = readOnly
+        # connections of each thread (see _connections), released when the thread ends, and all the connections
+        # currently open (see close)
+        self._local = threading.local()
+        self._opened = weakref.WeakSet()
+        self._lock = threading.Lock()
+
+        self._translationDir = translationDir
+        # directory of the WAV files (see getSegmentAudio)
+        self._wavDir = wavDir
         if translationDir != '':
             assert os.stat(translationDir), "The database doesn't exist!"
             self._translationStatus = True
-            self.translationDatabase = sqlite3.connect(translationDir)
-            self.translationDatabase.row_factory = sqlite3.Row
-            self.translationCursor = self.translationDatabase.cursor()
         else:
             self._translationStatus = False
 
@@ -430,6 +772,11 @@ class SpeechCoco:
         self._speakers = dict()
         self._createIndex()
         self._verbose = verbose
+        # whether the database has the alignment tables (see hasAlignmentTables)
+        self._alignmentTables = None
+        # parsed timecodes of the last cacheSize (captionID, seconds) pairs
+        self._alignmentCache = AlignmentCache(cacheSize)
+        self._cacheSize = cacheSize
 
     def _createIndex(self):
         query = 'SELECT * FROM speakers'
@@ -439,9 +786,219 @@ class SpeechCoco:
             self._speakers[row['name']] = Speaker(row)
 
     def __del__(self):
-        self.database.close()
-        self.cursor = None
-        self.database = None
+        if hasattr(self, '_opened'):
+            self.close()
+
+    def __getstate__(self):
+        # only the settings are pickled, the connections are opened again in the receiving process
+        return {'databaseDir': self._databaseDir, 'translationDir': self._translationDir, 'verbose': self._verbose,
+                'cacheSize': self._cacheSize, 'wavDir': self._wavDir, 'readOnly': self._readOnly}
+
+    def __setstate__(self, state):
+        self.__init__(**state)
+
+    def close(self):
+        """
+        Closes the connections opened by this object in the current process (connections inherited from a parent
+        process are left to it).
+
+        :return:
+        """
+        with self._lock:
+            opened, self._opened = list(self._opened), weakref.WeakSet()
+        for connections in opened:
+            connections.close()
+        self._local = threading.local()
+
+    def closeThread(self):
+        """
+        Closes the connections of the calling thread (they are closed anyway when the thread ends). They are opened
+        again if the thread uses the object afterwards.
+
+        :return:
+        """
+        connections = getattr(self._local, 'connections', None)
+        if connections is not None:
+            self._local.connections = None
+            connections.close()
+
+    #
+    #   Connections
+    #
+
+    @property
+    def database(self):
+        return self._connections().database
+
+    @property
+    def cursor(self):
+        return self._connections().cursor
+
+    @property
+    def translationDatabase(self):
+        return self._connections().translationDatabase
+
+    @property
+    def translationCursor(self):
+        return self._connections().translationCursor
+
+    def _connections(self):
+        # connections of the calling thread, opened on first use (and opened again in a forked process, as SQLite
+        # connections must not be used across a fork). Only the thread-local storage references them, hence they
+        # are closed when the thread ends.
+        connections = getattr(self._local, 'connections', None)
+        if connections is None or connections.pid != os.getpid():
+            translationDatabase = None
+            if self._translationStatus == True:
+                translationDatabase = self._connect(self._translationDir)
+            connections = ThreadConnections(self._connect(self._databaseDir), translationDatabase)
+            with self._lock:
+                self._opened.add(connections)
+            self._local.connections = connections
+        return connections
+
+    def _connect(self, path):
+        if self._readOnly == True and str is bytes:
+            # Python 2 can't open URIs: writes are refused by the connection instead
+            database = sqlite3.connect(path, check_same_thread=False)
+            database.execute('PRAGMA query_only = ON')
+        elif self._readOnly == True:
+            uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(path)))
+            database = sqlite3.connect(uri, uri=True, check_same_thread=False)
+        else:
+            database = sqlite3.connect(path, check_same_thread=False)
+        database.row_factory = sqlite3.Row
+        return database
+
+    def cacheInfo(self):
+        """
+        :return: hits, misses, size and maximum size of the cache of parsed timecodes
+        """
+        return self._alignmentCache.info()
+
+    def clearCache(self):
+        self._alignmentCache.clear()
+
+    def ensureIndexes(self):
+        """
+        Creates the secondary indexes missing from the database (e.g. databases created by older versions of
+        jsonToSQL) and updates the statistics used by the query planner.
+
+        :return:
+        """
+        if self._verbose == True:
+            print("|> Creating indexes ...")
+        SpeechCoco._createIndexes(self.database)
+        self.analyze()
+
+    def buildFullTextIndex(self):
+        """
+        Creates the FTS5 full-text index of the captions (if it doesn't exist yet), used by filterCaptions
+        when textMode is not LIKE. The index is kept up to date by triggers afterwards.
+
+        :return:
+        """
+        if self._verbose == True:
+            print("|> Building full-text index ...")
+        SpeechCoco._createFullTextIndex(self.database)
+
+    def buildWordIndex(self):
+        """
+        Creates the word index (word -> captionID, position, begin, end, speed) used by findWordOccurrences,
+        parsing the timecode of every caption of the database.
+
+        :return:
+        """
+        if self._verbose == True:
+            print("|> Building word index ...")
+        SpeechCoco._createWordIndex(self.database, rebuild=True)
+        self.ensureIndexes()
+
+    def buildAlignmentTables(self):
+        """
+        Creates the words, syllables and phonemes tables holding the parsed timecode of every caption
+        (captionID, position, parent, value, begin, end), times in milliseconds. The parent of a syllable
+        (resp. phoneme) is the position of its word (resp. syllable) in the caption.
+
+        :return:
+        """
+        if self._verbose == True:
+            print("|> Building alignment tables ...")
+        SpeechCoco._createAlignmentTables(self.database, rebuild=True)
+        self._alignmentTables = True
+        self.ensureIndexes()
+
+    def hasAlignmentTables(self):
+        """
+        Checked once per object (see buildAlignmentTables).
+
+        :return: True if the database contains the words, syllables and phonemes tables
+        """
+        if self._alignmentTables is None:
+            self._alignmentTables = all(self._hasTable(table) for table in ALIGNMENT_TABLES)
+        return self._alignmentTables
+
+    def getAlignment(self, captionID, seconds=False):
+        """
+        Builds the structure returned by Timecode.parse from the alignment tables, or parses the timecode of the
+        caption if they don't contain it.
+
+        :param captionID:
+        :param seconds:
+        :return:
+        """
+        if self.hasAlignmentTables():
+            alignment = self._readAlignment(captionID, seconds=seconds)
+            if alignment is not None:
+                return alignment
+        row = self.database.execute('SELECT timecode FROM captions WHERE captionID=?', (captionID,)).fetchone()
+        if row is None:
+            return []
+        return Timecode.s_parse(Timecode.load(row['timecode']), seconds=seconds)
+
+    def _readAlignment(self, captionID, seconds=False):
+        # alignment of the caption read from the alignment tables, None if they have no rows for it
+        convert = Timecode._milliToSec if seconds == True else (lambda t: t)
+        elements = []
+        for table in ALIGNMENT_TABLES:
+            query = 'SELECT parent, value, begin, end FROM {} WHERE captionID=? ORDER BY position'.format(table)
+            elements.append([(row['parent'], {'value': row['value'], 'begin': convert(row['begin']),
+                                              'end': convert(row['end'])})
+                             for row in self.database.execute(query, (captionID,))])
+        words, syllables, phonemes = elements
+        if len(words) == 0:
+            return None
+        for parent, phoneme in phonemes:
+            syllables[parent][1].setdefault('phoneme', []).append(phoneme)
+        for parent, syllable in syllables:
+            words[parent][1].setdefault('syllable', []).append(syllable)
+        return [word for _, word in words]
+
+    def hasWordIndex(self):
+        """
+
+        :return: True if the database contains the word index
+        """
+        return self._hasTable('wordIndex')
+
+    def hasFullTextIndex(self):
+        """
+
+        :return: True if the database contains the full-text index of the captions
+        """
+        return self._hasTable('captions_fts')
+
+    def _hasTable(self, name):
+        return SpeechCoco._tableExists(self.database, name)
+
+    def analyze(self):
+        """
+        Gathers the statistics used by SQLite's query planner to choose between the indexes.
+
+        :return:
+        """
+        self.database.execute('ANALYZE')
+        self.database.commit()
 
     #
     #   SPEAKERS
@@ -460,15 +1017,17 @@ class SpeechCoco:
             gender = [gender]
         speakers = []
 
+        params = []
         if len(nationality) == len(gender) == 0:
             query = 'SELECT * FROM speakers'
         else:
-            query = 'SELECT * FROM speakers WHERE ' + SpeechCoco._buildQuery(nationality=nationality, gender=gender)
+            whereQuery, params = SpeechCoco._buildQuery(nationality=nationality, gender=gender)
+            query = 'SELECT * FROM speakers WHERE ' + whereQuery
 
         if self._verbose == True:
             print("|> Querying ... {}".format(query))
 
-        self.cursor.execute(query)
+        self.cursor.execute(query, params)
         result = self.cursor.fetchall()
 
         if self._verbose == True:
@@ -485,37 +1044,50 @@ class SpeechCoco:
     #   IMAGES
     #
 
-    def getImgID(self):
+    def getImgID(self, pageSize=None, pageToken=None):
         """
 
+        :param pageSize: if given, returns a Page of at most pageSize imageIDs, in increasing order
+        :param pageToken: nextToken of the previous page
         :return:
         """
+        if pageSize is not None:
+            rows = self._fetchPage('SELECT DISTINCT imageID FROM captions', [], [], [('imageID', 'imageID')],
+                                   pageSize, pageToken)
+            return Page([row['imageID'] for row in rows], rows.nextToken)
+
         query = "SELECT DISTINCT imageID from captions"
         self.cursor.execute(query)
         result = self.cursor.fetchall()
         return [value['imageID'] for value in result]
 
-    def getImgCaptions(self, imgID, raw=False):
+    def getImgCaptions(self, imgID, raw=False, stream=False, pageSize=None, pageToken=None):
         """
 
         :param imgID:
+        :param stream: if True, returns a generator yielding the results one at a time
+        :param pageSize: if given, returns a Page of at most pageSize captions, ordered by imageID and captionID
+        :param pageToken: nextToken of the previous page
         :return:
         """
 
-        if type(imgID) is list:
-            baseQuery="SELECT * FROM captions WHERE "
-            query=baseQuery+SpeechCoco._buildQuery(imageID=imgID)
+        keys = [('imageID', 'imageID'), ('captionID', 'captionID')]
+        if pageSize is not None:
+            stream = False
+        if pageSize is not None and type(imgID) is list:
+            result = self._fetchPageIn("SELECT * FROM captions", [], [], 'imageID', imgID, keys, pageSize, pageToken)
+        elif pageSize is not None:
+            result = self._fetchPage("SELECT * FROM captions", ['imageID=?'], [imgID], keys, pageSize, pageToken)
+        elif type(imgID) is list:
+            result = self._fetchIn("SELECT * FROM captions", 'imageID', imgID, stream=stream)
         else:
-            query="SELECT * FROM captions WHERE imageID={}".format(imgID)
-
-        self.cursor.execute(query)
-        result = self.cursor.fetchall()
+            result = self._fetch("SELECT * FROM captions WHERE imageID=?", (imgID,), stream=stream)
 
         if self._verbose == True:
             print("|> Query executed!")
 
         if raw == False:
-            return [Caption(self._speakers[value['speaker']], value) for value in result]
+            return self._toCaptions(result, stream=stream)
         else:
             return result
 
@@ -524,14 +1096,36 @@ class SpeechCoco:
     #
 
     def filterCaptions(self, speaker=[], gender=[], disfluencyPos=[], nationality=[], speed=[], text=[],
-                       duration=lambda d: d >= 0, raw=False):
+                       duration=lambda d: d >= 0, raw=False, stream=False, textMode=LIKE, minDuration=None,
+                       maxDuration=None, minSpeed=None, maxSpeed=None, translations=[], pageSize=None, pageToken=None):
         """
         :param speaker:
         :param gender:
         :param disfluencyPos:
         :param nationality:
         :param speed:
-        :param duration:
+        :param text:
+        :param duration: predicate applied to the duration of each caption. Prefer minDuration and maxDuration
+                         which are evaluated by SQLite.
+        :param raw:
+        :param stream: if True, returns a generator yielding the results one at a time
+        :param textMode: LIKE -> text values are SQL LIKE patterns (e.g. '%keys%')
+                         WORD -> captions containing all the words of the text value
+                         PREFIX -> captions containing words starting with each word of the text value
+                         PHRASE -> captions containing the text value as a phrase
+                         MATCH -> text values are raw FTS5 queries
+                         All modes but LIKE use the full-text index (see buildFullTextIndex) and fall back to
+                         LIKE '%text%' when the database doesn't have one.
+        :param minDuration: minimum duration (inclusive)
+        :param maxDuration: maximum duration (inclusive)
+        :param minSpeed: minimum speed (inclusive)
+        :param maxSpeed: maximum speed (inclusive)
+        :param translations: languages (e.g. 'ja_google') whose translation is joined to each caption. Other
+                             fields are selected with 'language.field' (e.g. 'ja_google.tokens'). They are
+                             returned as columns named after the language (resp. language_field) and in the
+                             translations attribute of the Caption objects. See attachTranslations.
+        :param pageSize: if given, returns a Page of at most pageSize captions, ordered by captionID
+        :param pageToken: nextToken of the previous page
         :return:
         """
         if type(nationality) is str:
@@ -551,67 +1145,447 @@ class SpeechCoco:
 
         if type(speed) is int or type(speed) is float:
             speed = [speed]
+
+        if type(translations) is str:
+            translations = [translations]
+
         query = 'SELECT * FROM captions INNER JOIN speakers ON captions.speaker=speakers.name '
+        params = []
+
+        translationColumns = []
+        if len(translations) != 0:
+            # only the aliased columns of the translation tables are selected (not their captionID, etc.)
+            select, joins, translationColumns = self._joinTranslations(translations)
+            query = 'SELECT captions.*, speakers.*, {} FROM captions ' \
+                    'INNER JOIN speakers ON captions.speaker=speakers.name {} '.format(select, joins)
+
+        fullText = []
+        if len(text) != 0 and textMode != LIKE:
+            if self.hasFullTextIndex():
+                fullText, text = text, []
+            else:
+                if self._verbose == True:
+                    print("|> No full-text index, falling back to LIKE!")
+                text = ['%' + item + '%' for item in text]
 
+        whereQuery = []
         if len(speaker) != 0 or len(gender) != 0 or len(disfluencyPos) != 0 or len(nationality) != 0 or len(speed) != 0 or len(text) != 0:
-            whereQuery = SpeechCoco._buildQuery(speaker=speaker, gender=gender, disfluencyPos=disfluencyPos,
-                                                nationality=nationality, speed=speed, text=text)
-            query = query + 'WHERE ' + whereQuery
+            filterQuery, filterParams = SpeechCoco._buildQuery(speaker=speaker, gender=gender,
+                                                               disfluencyPos=disfluencyPos, nationality=nationality,
+                                                               speed=speed, text=text)
+            whereQuery.append(filterQuery)
+            params.extend(filterParams)
+        if len(fullText) != 0:
+            whereQuery.append('captions.captionID IN (SELECT rowid FROM captions_fts WHERE captions_fts MATCH ?)')
+            params.append(SpeechCoco._buildMatch(fullText, textMode))
+        for column, operator, value in [('duration', '>=', minDuration), ('duration', '<=', maxDuration),
+                                        ('speed', '>=', minSpeed), ('speed', '<=', maxSpeed)]:
+            if value is not None:
+                whereQuery.append('captions.{} {} ?'.format(column, operator))
+                params.append(value)
+
+        if pageSize is not None:
+            result = self._fetchPage(query, whereQuery, params, [('captions.captionID', 'captionID')], pageSize,
+                                     pageToken, predicate=lambda row: duration(row['duration']))
+            if raw == False:
+                return Page(self._toCaptions(result, translations=translationColumns), result.nextToken)
+            return result
+
+        if len(whereQuery) != 0:
+            query = query + 'WHERE ' + ' AND '.join(whereQuery)
 
         if self._verbose == True:
             print("|> Querying ... {}".format(query))
 
-        self.cursor.execute(query)
-        result = self.cursor.fetchall()
+        # the duration predicate is applied while streaming the rows, so that only the matching ones are kept
+        result = (row for row in self._iterRows(query, params) if duration(row['duration']))
+        if stream == False:
+            result = list(result)
 
         if self._verbose == True:
             print("|> Query executed!")
 
         if raw == False:
-            return [Caption(self._speakers[value['speaker']], value) for value in result if duration(value['duration'])]
+            return self._toCaptions(result, stream=stream, translations=translationColumns)
         else:
             return result
 
-    def queryCaptions(self, query):
+    def iterCaptions(self, **kwargs):
+        """
+        Same as filterCaptions but yields the Caption objects one at a time, pulling the rows
+        from the database in batches of FETCH_SIZE.
+
+        :param kwargs: filters accepted by filterCaptions
+        :return: generator
+        """
+        kwargs['stream'] = True
+        return self.filterCaptions(**kwargs)
+
+    def findWordOccurrences(self, word, speaker=[], gender=[], nationality=[], speed=[], stream=False, pageSize=None,
+                            pageToken=None):
+        """
+        Returns the occurrences of a word (or list of words) in the corpus using the word index
+        (see buildWordIndex), without parsing any timecode.
+
+        :param word: word or list of words (case insensitive)
+        :param speaker:
+        :param gender:
+        :param nationality:
+        :param speed:
+        :param stream: if True, returns a generator yielding the results one at a time
+        :param pageSize: if given, returns a Page of at most pageSize rows, ordered by captionID and position.
+                         Pages of a single word seek in the (word, captionID, position) index (see ensureIndexes
+                         for databases created before it)
+        :param pageToken: nextToken of the previous page
+        :return: rows (word, captionID, position, begin, end, speed, speaker, wavFilename). Times are in seconds
+                 and position is the index of the word in the caption, silences excluded.
+        """
+        assert self.hasWordIndex(), "|> No word index, see buildWordIndex!"
+        if type(word) is str:
+            word = [word]
+        if type(speaker) is str:
+            speaker = [speaker]
+        if type(gender) is str:
+            gender = [gender]
+        if type(nationality) is str:
+            nationality = [nationality]
+        if type(speed) is int or type(speed) is float:
+            speed = [speed]
+
+        query = 'SELECT wordIndex.word, wordIndex.captionID, wordIndex.position, wordIndex.begin, wordIndex.end, ' \
+                'wordIndex.speed, captions.speaker, captions.wavFilename FROM wordIndex ' \
+                'INNER JOIN captions ON wordIndex.captionID=captions.captionID ' \
+                'INNER JOIN speakers ON captions.speaker=speakers.name '
+        whereQuery, params = SpeechCoco._buildQuery(**{'wordIndex.word': [w.lower() for w in word],
+                                                       'wordIndex.speed': speed, 'captions.speaker': speaker,
+                                                       'gender': gender, 'nationality': nationality})
+        if pageSize is not None:
+            return self._fetchPage(query, [whereQuery], params, [('wordIndex.captionID', 'captionID'),
+                                                                 ('wordIndex.position', 'position')],
+                                   pageSize, pageToken)
+        query = query + 'WHERE ' + whereQuery
+
+        if self._verbose == True:
+            print("|> Querying ... {}".format(query))
+
+        result = self._fetch(query, params, stream=stream)
+
+        if self._verbose == True:
+            print("|> Query executed!")
+
+        return result
+
+    def extractWordOccurrences(self, word, speaker=[], gender=[], nationality=[], speed=[], padding=0.0,
+                               maxOpen=16):
+        """
+        Cuts the audio of every occurrence of a word (see findWordOccurrences) from the memory-mapped WAV files.
+        Occurrences are streamed and at most maxOpen files are mapped at once. Requires NumPy.
+
+        :param word: word or list of words (case insensitive)
+        :param speaker:
+        :param gender:
+        :param nationality:
+        :param speed:
+        :param padding: seconds added before and after each occurrence
+        :param maxOpen: maximum number of WAV files mapped at once
+        :return: generator yielding (row, samples) pairs, row being a row of findWordOccurrences and samples a
+                 read-only NumPy view of the samples of the occurrence
+        """
+        from .audio import extractOccurrences
+
+        assert self._wavDir != '', "|> No WAV directory given!"
+        rows = self.findWordOccurrences(word, speaker=speaker, gender=gender, nationality=nationality, speed=speed,
+                                        stream=True)
+        return extractOccurrences(rows, self._wavDir, padding=padding, maxOpen=maxOpen)
+
+    def getSegmentAudio(self, caption, begin, end, seconds=True):
+        """
+        See Caption.getSegmentAudio.
+
+        :param caption: Caption object or captionID
+        :param begin:
+        :param end:
+        :param seconds:
+        :return:
+        """
+        if not isinstance(caption, Caption):
+            caption = self.selectCaptions(caption)[0]
+        assert self._wavDir != '', "|> No WAV directory given!"
+        return caption.getSegmentAudio(begin, end, seconds=seconds, wavDir=self._wavDir)
+
+    def queryCaptions(self, query, stream=False):
         """
         :param query: user's own SQL query
+        :param stream: if True, returns a generator yielding the rows one at a time
         :return: results
         """
 
         if self._verbose == True:
             print("|> Querying ... {}".format(query))
 
-        self.cursor.execute(query)
-        result = self.cursor.fetchall()
+        result = self._fetch(query, stream=stream)
 
         if self._verbose == True:
             print("|> Query executed!")
 
         return result
 
-    def selectCaptions(self, captionID, raw=False):
+    def selectCaptions(self, captionID, raw=False, stream=False, pageSize=None, pageToken=None):
         """
 
                 :param captionID:
+                :param stream: if True, returns a generator yielding the results one at a time
+                :param pageSize: if given, returns a Page of at most pageSize captions, ordered by captionID
+                :param pageToken: nextToken of the previous page
                 :return:
                 """
 
-        if type(captionID) is list:
-            baseQuery = "SELECT * FROM captions WHERE "
-            query = baseQuery   + SpeechCoco._buildQuery(captionID=captionID)
+        if pageSize is not None:
+            stream = False
+            captionIDs = captionID if type(captionID) is list else [captionID]
+            result = self._fetchPageIn("SELECT * FROM captions", [], [], 'captionID', captionIDs,
+                                       [('captionID', 'captionID')], pageSize, pageToken)
+        elif type(captionID) is list:
+            result = self._fetchIn("SELECT * FROM captions", 'captionID', captionID, stream=stream)
         else:
-            query = "SELECT * FROM captions WHERE captionID={}".format(captionID)
-
-        self.cursor.execute(query)
-        result = self.cursor.fetchall()
+            result = self._fetch("SELECT * FROM captions WHERE captionID=?", (captionID,), stream=stream)
 
         if self._verbose == True:
             print("|> Query executed!")
 
         if raw == False:
-            return [Caption(self._speakers[value['speaker']], value) for value in result]
+            return self._toCaptions(result, stream=stream)
         else:
             return result
+
+    def _fetch(self, query, params=(), stream=False):
+        if stream == True:
+            return self._iterRows(query, params)
+        self.cursor.execute(query, params)
+        return self.cursor.fetchall()
+
+    def _toCaption(self, row, translations=[]):
+        caption = Caption(self._speakers[row['speaker']], row, cache=self._alignmentCache, owner=self)
+        for column in translations:
+            caption.translations[column] = row[column]
+        return caption
+
+    def _fetchIn(self, query, column, values, stream=False, database=None):
+        # SELECT ... WHERE column IN (values), looked up by chunks of IN_CHUNK_SIZE values. When there are several
+        # chunks, the last one is padded so that every chunk runs the same (cached) prepared statement.
+        values = SpeechCoco._unique(values)
+        size = min(len(values), IN_CHUNK_SIZE)
+        if size == 0:
+            return iter([]) if stream == True else []
+        chunkQuery = query + ' WHERE {} IN ({})'.format(column, ','.join('?' * size))
+        chunks = []
+        for i in range(0, len(values), size):
+            chunk = values[i:i + size]
+            chunks.append(chunk + chunk[-1:] * (size - len(chunk)))
+        result = itertools.chain.from_iterable(self._iterRows(chunkQuery, chunk, database=database) for chunk in chunks)
+        if stream == True:
+            return result
+        return list(result)
+
+    def _iterRows(self, query, params=(), fetchSize=FETCH_SIZE, database=None):
+        # a dedicated cursor is used so that the shared one can still be used while the generator is alive
+        cursor = (database or self.database).cursor()
+        try:
+            cursor.execute(query, params)
+            while True:
+                rows = cursor.fetchmany(fetchSize)
+                if not rows:
+                    break
+                for row in rows:
+                    yield row
+        finally:
+            cursor.close()
+
+    def _toCaptions(self, rows, stream=False, translations=[]):
+        captions = (self._toCaption(row, translations) for row in rows)
+        if stream == True:
+            return captions
+        if isinstance(rows, Page):
+            return Page(captions, rows.nextToken)
+        return list(captions)
+
+    def _fetchPage(self, query, where, params, keys, pageSize, pageToken=None, predicate=None):
+        # keyset pagination: the rows following the key of pageToken in the order of keys, a list of (column, name
+        # of the column in the rows), which must identify the rows. Seeking to the key uses the indexes, hence the
+        # cost of a page doesn't depend on its depth.
+        key = Page.decodeToken(pageToken, len(keys)) if pageToken is not None else None
+        rows = self._seekRows(query, where, params, keys, key, pageSize + 1, predicate)
+        return self._toPage(rows, keys, pageSize)
+
+    def _fetchPageIn(self, query, where, params, column, values, keys, pageSize, pageToken=None):
+        # same as _fetchPage, for the rows whose column (the first key) is in values, looked up by chunks of
+        # IN_CHUNK_SIZE values in increasing order
+        key = Page.decodeToken(pageToken, len(keys)) if pageToken is not None else None
+        values = sorted(SpeechCoco._unique(values))
+        start = bisect.bisect_left(values, key[0]) if key is not None else 0
+        rows = []
+        for i in range(start, len(values), IN_CHUNK_SIZE):
+            chunk = values[i:i + IN_CHUNK_SIZE]
+            chunkWhere = where + ['{} IN ({})'.format(column, ','.join('?' * len(chunk)))]
+            rows.extend(self._seekRows(query, chunkWhere, params + chunk, keys, key, pageSize + 1 - len(rows)))
+            if len(rows) > pageSize:
+                break
+        return self._toPage(rows, keys, pageSize)
+
+    def _seekRows(self, query, where, params, keys, key, limit, predicate=None):
+        # at most limit rows (matching predicate) following key
+        rows = []
+        columns = [column for column, _ in keys]
+        while len(rows) < limit:
+            seekWhere, seekParams = list(where), list(params)
+            if key is not None:
+                if ROW_VALUES or len(columns) == 1:
+                    seekWhere.append('({}) > ({})'.format(', '.join(columns), ','.join('?' * len(columns))))
+                    seekParams.extend(key)
+                else:
+                    seekWhere.append('({} > ? OR ({} = ? AND {} > ?))'.format(columns[0], columns[0], columns[1]))
+                    seekParams.extend([key[0], key[0], key[1]])
+            seekQuery = query + (' WHERE ' + ' AND '.join(seekWhere) if len(seekWhere) != 0 else '') + \
+                        ' ORDER BY {} LIMIT ?'.format(', '.join(columns))
+            size = limit - len(rows)
+            batch = self.database.execute(seekQuery, seekParams + [size]).fetchall()
+            rows.extend(row for row in batch if predicate is None or predicate(row))
+            if len(batch) < size:
+                break
+            key = [batch[-1][name] for _, name in keys]
+        return rows[:limit]
+
+    def _toPage(self, rows, keys, pageSize):
+        if len(rows) > pageSize:
+            return Page(rows[:pageSize], Page.encodeToken([rows[pageSize - 1][name] for _, name in keys]))
+        return Page(rows)
+
+    #
+    #   STATISTICS
+    #
+
+    def buildStats(self):
+        """
+        Creates (or rebuilds) the captionStats table: number of captions, total duration and number of tokens
+        for each (speaker, speed, disfluencyPos, durationBin) combination, durationBin being the index of the
+        STATS_BIN_WIDTH seconds wide duration bin. The table is kept up to date by triggers afterwards (see also
+        the stats parameter of jsonToSQL).
+
+        :return:
+        """
+        if self._verbose == True:
+            print("|> Building statistics ...")
+        SpeechCoco._createStats(self.database, rebuild=True)
+
+    def hasStats(self):
+        """
+
+        :return: True if the database contains the statistics table
+        """
+        return self._hasTable('captionStats')
+
+    def stats(self, groupBy=['speaker'], speaker=[], gender=[], nationality=[], speed=[], disfluencyPos=[]):
+        """
+        Statistics of the captions matching the filters, read from the captionStats table (see buildStats).
+
+        :param groupBy: columns the statistics are grouped by, among STATS_GROUPS
+        :param speaker:
+        :param gender:
+        :param nationality:
+        :param speed:
+        :param disfluencyPos:
+        :return: list of dicts with the groupBy columns, the number of captions, their total and mean duration and
+                 their number of tokens. When grouped by durationBin, durationBegin and durationEnd give the bounds
+                 of the bin.
+        """
+        assert self.hasStats(), "|> No statistics, see buildStats!"
+        if type(groupBy) is str:
+            groupBy = [groupBy]
+        for column in groupBy:
+            assert column in STATS_GROUPS, "|> Can't group by {}!".format(column)
+        filters = {'captionStats.speaker': speaker, 'gender': gender, 'nationality': nationality,
+                   'captionStats.speed': speed, 'captionStats.disfluencyPos': disfluencyPos}
+        for key, value in filters.items():
+            if type(value) is str or type(value) is int or type(value) is float:
+                filters[key] = [value]
+
+        columns = ['captionStats.' + column if column not in ['gender', 'nationality'] else column
+                   for column in groupBy]
+        query = 'SELECT {}SUM(captions) AS captions, SUM(duration) AS duration, SUM(tokens) AS tokens ' \
+                'FROM captionStats INNER JOIN speakers ON captionStats.speaker=speakers.name '.format(
+                    ''.join(column + ', ' for column in columns))
+        params = []
+        if any(len(value) != 0 for value in filters.values()):
+            whereQuery, params = SpeechCoco._buildQuery(**filters)
+            query = query + 'WHERE ' + whereQuery + ' '
+        # HAVING requires GROUP BY before SQLite 3.39: without groups, the empty (NULL) total is skipped below
+        if len(columns) != 0:
+            query = query + 'GROUP BY {0} HAVING SUM(captions) > 0 ORDER BY {0}'.format(', '.join(columns))
+
+        result = []
+        for row in self.database.execute(query, params):
+            if not row['captions']:
+                continue
+            item = dict((column, row[i]) for i, column in enumerate(groupBy))
+            item.update({'captions': row['captions'], 'duration': row['duration'],
+                         'meanDuration': row['duration'] / row['captions'], 'tokens': row['tokens']})
+            if 'durationBin' in item:
+                item['durationBegin'] = item['durationBin'] * STATS_BIN_WIDTH
+                item['durationEnd'] = (item['durationBin'] + 1) * STATS_BIN_WIDTH
+            result.append(item)
+        return result
+
+    def durationHistogram(self, speaker=[], gender=[], nationality=[], speed=[], disfluencyPos=[]):
+        """
+        Histogram of the durations of the captions matching the filters (see stats).
+
+        :return: list of (durationBegin, durationEnd, number of captions), one per non-empty bin
+        """
+        return [(item['durationBegin'], item['durationEnd'], item['captions'])
+                for item in self.stats(groupBy=['durationBin'], speaker=speaker, gender=gender,
+                                       nationality=nationality, speed=speed, disfluencyPos=disfluencyPos)]
+
+    #
+    #   EXPORT
+    #
+
+    def exportTextGrids(self, outputDir, level=3, workers=None, **filters):
+        """
+        Writes the Praat TextGrid file of every caption matching the filters (see filterCaptions) to outputDir.
+        The files are rendered and written by a pool of processes, each one reading the timecodes it needs
+        from its own connection to the database.
+
+        :param outputDir: directory where the TextGrid files are written (created if needed)
+        :param level: see Timecode.s_toTextgrid
+        :param workers: number of processes (defaults to the number of CPUs)
+        :param filters: arguments of filterCaptions
+        :return: dict with the number of files written, the time spent and the throughput (files/s)
+        """
+        filters['raw'] = True
+        filters['stream'] = True
+        captionIDs = [row['captionID'] for row in self.filterCaptions(**filters)]
+        chunks = [captionIDs[i:i + IN_CHUNK_SIZE] for i in range(0, len(captionIDs), IN_CHUNK_SIZE)]
+
+        if not os.path.isdir(outputDir):
+            os.makedirs(outputDir)
+
+        if self._verbose == True:
+            print("|> Exporting {} TextGrid files to {} ...".format(len(captionIDs), outputDir))
+        report = {'files': 0}
+        startTime = time.time()
+        export = functools.partial(_exportTextgrids, databaseDir=self._databaseDir, outputDir=outputDir, level=level)
+        for written in _mapFiles(export, chunks, workers, chunksize=1):
+            report['files'] += written
+            if self._verbose == True:
+                print("\t{} / {} files written ({:0.0f} files/s)".format(
+                    report['files'], len(captionIDs), report['files'] / max(time.time() - startTime, 1e-6)))
+        report['seconds'] = time.time() - startTime
+        report['filesPerSecond'] = report['files'] / max(report['seconds'], 1e-6)
+
+        if self._verbose == True:
+            print("|> {files} files written in {seconds:0.2f}s ({filesPerSecond:0.0f} files/s)".format(**report))
+        return report
+
     #
     #   TRANSLATIONS
     #
@@ -647,27 +1621,204 @@ class SpeechCoco:
         result = self.translationCursor.fetchone()
         return result['pos']
 
+    def getTranslations(self, captionID, language, fields=['caption']):
+        """
+        Batch version of getTranslation, getTokens and getPOS: returns the requested fields for many captions
+        and languages, with one query per language and chunk of IN_CHUNK_SIZE captions.
+
+        :param captionID: list of captionIDs, Caption objects or rows (e.g. the result of filterCaptions)
+        :param language: language or list of languages (e.g. ['ja_google', 'ja_excite'])
+        :param fields: fields to return among 'caption', 'tokens' and 'pos'
+        :return: dict captionID -> language -> field -> value. Captions without translation are left out.
+        """
+        assert language, "|> No langage specified!"
+        if type(language) is str:
+            language = [language]
+        if type(fields) is str:
+            fields = [fields]
+
+        captionIDs = []
+        for item in captionID:
+            if isinstance(item, Caption):
+                item = item.captionID
+            elif isinstance(item, sqlite3.Row):
+                item = item['captionID']
+            captionIDs.append(item)
+
+        translations = dict()
+        for lang in language:
+            self._checkLanguage(lang, fields)
+            query = 'SELECT captionID, {} FROM {}'.format(', '.join(fields), lang)
+            for row in self._fetchIn(query, 'captionID', captionIDs, stream=True, database=self.translationDatabase):
+                translations.setdefault(row['captionID'], dict())[lang] = dict((field, row[field]) for field in fields)
+        return translations
+
+    def attachTranslations(self):
+        """
+        Attaches the translation database to the caption database (as 'translations'), so that translations can be
+        joined to the captions by filterCaptions. Called automatically when needed.
+
+        :return:
+        """
+        assert self._translationStatus, "|> No translation database specified!"
+        connections = self._connections()
+        if connections.attached == False:
+            if self._readOnly == True:
+                uri = 'file:{}?mode=ro'.format(pathname2url(os.path.abspath(self._translationDir)))
+                connections.database.execute('ATTACH DATABASE ? AS translations', (uri,))
+            else:
+                connections.database.execute('ATTACH DATABASE ? AS translations', (self._translationDir,))
+            connections.attached = True
+
+    def _checkLanguage(self, language, fields):
+        # languages and fields are used as identifiers in the queries, hence they are checked beforehand
+        assert language in self.getLanguages(), "|> Unknown language {}!".format(language)
+        columns = [row['name'] for row in self.translationDatabase.execute('PRAGMA table_info({})'.format(language))]
+        for field in fields:
+            assert field in columns, "|> No field {} for language {}!".format(field, language)
+
+    def _joinTranslations(self, translations):
+        # SELECT and JOIN clauses adding the requested translations to a query on the captions table
+        self.attachTranslations()
+        select, joins, columns, joined = [], [], [], set()
+        for item in translations:
+            language, _, field = item.partition('.')
+            self._checkLanguage(language, [field or 'caption'])
+            column = language + '_' + field if field else language
+            table = 'translation_' + language
+            select.append('{}.{} AS {}'.format(table, field or 'caption', column))
+            if table not in joined:
+                joined.add(table)
+                joins.append('LEFT JOIN translations.{} AS {} ON {}.captionID=captions.captionID'.format(
+                    language, table, table))
+            columns.append(column)
+        return ', '.join(select), ' '.join(joins), columns
+
     #
     #   STATIC METHODS
     #
 
     @staticmethod
     def _buildQuery(**kwargs):
+        # returns the WHERE clause and its parameters. Keys are sorted so that the same filters always give the
+        # same statement, which is then reused from sqlite3's statement cache.
         query = []
-        for key, value in kwargs.items():
+        params = []
+        for key, value in sorted(kwargs.items()):
             if value != []:
                 if key != 'text':
-                    equal = '='
+                    query.append(key + ' IN (' + ','.join('?' * len(value)) + ')')
                 else:
-                    equal = ' LIKE '
-                query.append(key + equal + str(' OR ' + key + equal).join('"' + str(item) + '"' for item in value))
-        return ' AND '.join("(" + item + ")" for item in query)
+                    query.append(' OR '.join(key + ' LIKE ?' for item in value))
+                params.extend(value)
+        return ' AND '.join("(" + item + ")" for item in query), params
+
+    @staticmethod
+    def _unique(values):
+        seen = set()
+        return [value for value in values if not (value in seen or seen.add(value))]
+
+    @staticmethod
+    def convertTimecodes(databaseDir, binary=True, verbose=False, batchSize=5000):
+        """
+        Converts the timecodes of an existing database to the binary format (or back to JSON if binary is False)
+        and reports the size and decoding time of the timecode column before and after.
+
+        :param databaseDir: database to convert (in place)
+        :param binary:
+        :param verbose:
+        :param batchSize: number of captions converted per transaction
+        :return: dict with the number of captions, the size of the timecode column (bytes), the size of the file
+                 and the time spent decoding the timecode column, before and after the conversion
+        """
+        database = sqlite3.connect(databaseDir)
+        report = {'captions': 0}
+        report['columnBefore'], report['decodeBefore'] = SpeechCoco._timecodeColumnStats(database)
+        report['fileBefore'] = os.path.getsize(databaseDir)
+
+        lastID = None
+        while True:
+            if lastID is None:
+                rows = database.execute('SELECT captionID, timecode FROM captions ORDER BY captionID LIMIT ?',
+                                        (batchSize,)).fetchall()
+            else:
+                rows = database.execute('SELECT captionID, timecode FROM captions WHERE captionID>? ORDER BY captionID LIMIT ?',
+                                        (lastID, batchSize)).fetchall()
+            if len(rows) == 0:
+                break
+            with database:
+                database.executemany('UPDATE captions SET timecode=? WHERE captionID=?',
+                                     [(_bindTimecode(_storeTimecode(Timecode.load(timecode), binary)), captionID)
+                                      for captionID, timecode in rows])
+            lastID = rows[-1][0]
+            report['captions'] += len(rows)
+            if verbose == True:
+                print("\t{} captions converted".format(report['captions']))
+
+        database.execute('VACUUM')
+        report['columnAfter'], report['decodeAfter'] = SpeechCoco._timecodeColumnStats(database)
+        report['fileAfter'] = os.path.getsize(databaseDir)
+        database.close()
+
+        if verbose == True:
+            print("|> Timecode column: {columnBefore} -> {columnAfter} bytes, decoded in "
+                  "{decodeBefore:0.2f}s -> {decodeAfter:0.2f}s".format(**report))
+            print("|> Database file: {fileBefore} -> {fileAfter} bytes".format(**report))
+        return report
+
+    @staticmethod
+    def _timecodeColumnStats(database):
+        # total size of the timecode column and time needed to decode all of it
+        size = 0
+        decoding = 0.0
+        for (timecode,) in database.execute('SELECT timecode FROM captions'):
+            size += len(timecode)
+            startTime = time.time()
+            Timecode.load(timecode)
+            decoding += time.time() - startTime
+        return size, decoding
+
+    @staticmethod
+    def _buildMatch(text, textMode):
+        # builds an FTS5 query matching any of the text values
+        query = []
+        for item in text:
+            if textMode == MATCH:
+                query.append(item)
+            elif textMode == PHRASE:
+                query.append(SpeechCoco._quoteMatch(item))
+            elif textMode == WORD:
+                query.append(' '.join(SpeechCoco._quoteMatch(word) for word in item.split()))
+            elif textMode == PREFIX:
+                query.append(' '.join(SpeechCoco._quoteMatch(word) + '*' for word in item.split()))
+            else:
+                raise ValueError("Unknown text mode {}".format(textMode))
+        return ' OR '.join('(' + item + ')' for item in query)
 
     @staticmethod
-    def jsonToSQL(dirJsons, mergedFilename='./speechCoco.sqlite3', verbose=False):
+    def _quoteMatch(text):
+        return '"' + text.replace('"', '""') + '"'
+
+    @staticmethod
+    def jsonToSQL(dirJsons, mergedFilename='./speechCoco.sqlite3', verbose=False, workers=None, batchSize=5000,
+                  incremental=False, fullText=False, wordIndex=False, alignments=False, binaryTimecode=False,
+                  stats=False):
         """
         :param dirJsons: directory to the JSON files
         :param mergedFilename: database name
+        :param workers: number of processes parsing the JSON files (defaults to the number of CPUs)
+        :param batchSize: number of captions inserted per transaction
+        :param incremental: if True, the files already ingested (same name, size and modification time) are
+                            skipped. This is also the way to resume an interrupted ingestion, since every batch
+                            is committed along with its entries in the ingestion manifest.
+        :param fullText: if True, the FTS5 full-text index of the captions is built
+        :param wordIndex: if True, the word index used by findWordOccurrences is built (it is always updated if
+                          the database already has one)
+        :param alignments: if True, the words, syllables and phonemes tables are built (see buildAlignmentTables)
+                           They are always updated if the database already has them.
+        :param binaryTimecode: if True, the timecodes are stored in binary (see Timecode.encode) instead of JSON
+        :param stats: if True, the statistics table is built (see SpeechCoco.buildStats). It is always updated if
+                      the database already has it.
         :return:
         """
 
@@ -695,6 +1846,12 @@ class SpeechCoco:
         database = sqlite3.connect(mergedFilename)
         db = database.cursor()
 
+        # bulk-load settings, restored once the data is written
+        db.execute("PRAGMA journal_mode = WAL")
+        db.execute("PRAGMA synchronous = OFF")
+        db.execute("PRAGMA cache_size = -262144")
+        db.execute("PRAGMA temp_store = MEMORY")
+
         if verbose==True:
             print("Writing DATA")
 
@@ -705,27 +1862,301 @@ class SpeechCoco:
         db.execute(
             'CREATE TABLE IF NOT EXISTS captions (captionID INTEGER PRIMARY KEY, imageID INTEGER, wavFilename TEXT, duration FLOAT, timecode TEXT, disfluencyPos TEXT, disfluencyVal TEXT, speed FLOAT, text TEXT, speaker TEXT)')
 
-        filesInDir = os.listdir(dirJsons)
-        for number, files in enumerate(filesInDir):
-            if verbose:
-                print("\t{}/{} {}".format(number + 1, len(filesInDir), files))
-
-            with open(os.path.join(dirJsons, files)) as jsonFile:
-                jsonData = json.load(jsonFile)
-                imageInsert = "INSERT INTO captions (captionID, imageID, wavFilename, duration, timecode, disfluencyPos, disfluencyVal, speed, text, speaker) VALUES (?,?,?,?,?,?,?,?,?,?)"
-                db.execute(imageInsert, (
-                jsonData['captionID'], jsonData['imgID'], jsonData['wavFilename'], jsonData['duration'],
-                json.dumps(jsonData['timecode']), jsonData['disfluency'][0], jsonData['disfluency'][1],
-                jsonData['speed'], jsonData['synthesisedCaption'], jsonData['speaker']))
-
-                speakerInsertion = 'INSERT OR IGNORE INTO speakers (name, nationality, gender) VALUES (?,?,?)'
-                db.execute(speakerInsertion, (jsonData['speaker'], speakers[jsonData['speaker']][0], speakers[jsonData['speaker']][1]))
-
+        # Ingestion manifest: one entry per JSON file written in the database
+        db.execute(
+            'CREATE TABLE IF NOT EXISTS ingestion (filename TEXT PRIMARY KEY, size INTEGER, mtime FLOAT, captionID INTEGER)')
+        manifest = dict((row[0], row[1:]) for row in db.execute('SELECT filename, size, mtime, captionID FROM ingestion'))
+
+        wordIndex = wordIndex == True or SpeechCoco._tableExists(database, 'wordIndex')
+        if wordIndex == True:
+            SpeechCoco._createWordIndex(database)
+        alignments = alignments == True or SpeechCoco._tableExists(database, ALIGNMENT_TABLES[0])
+        if alignments == True:
+            SpeechCoco._createAlignmentTables(database)
+        # the statistics are updated by triggers as the captions are written
+        if stats == True or SpeechCoco._tableExists(database, 'captionStats'):
+            SpeechCoco._createStats(database)
+
+        filesInDir = []
+        for files in os.listdir(dirJsons):
+            stat = os.stat(os.path.join(dirJsons, files))
+            previous = manifest.get(files)
+            if incremental == True and previous is not None and previous[:2] == (stat.st_size, stat.st_mtime):
+                continue
+            # the caption previously read from this file (if any) is replaced
+            filesInDir.append((dirJsons, files, stat.st_size, stat.st_mtime, previous[2] if previous else None))
+        manifest = None
+
+        if verbose and incremental == True:
+            print("\t{} new or modified files".format(len(filesInDir)))
+
+        nbFiles = len(filesInDir)
+        nbDone = 0
+        batch = []
+        readCaptionFile = functools.partial(_readCaptionFile, wordIndex=wordIndex, alignments=alignments,
+                                            binaryTimecode=binaryTimecode)
+        for row in _mapFiles(readCaptionFile, filesInDir, workers):
+            batch.append(row)
+            if len(batch) >= batchSize:
+                nbDone += SpeechCoco._insertBatch(database, batch, speakers)
+                batch = []
+                if verbose:
+                    print("\t{}/{} files ({:0.0f} files/s)".format(nbDone, nbFiles, nbDone / (time.time() - startTime)))
+        nbDone += SpeechCoco._insertBatch(database, batch, speakers)
+
+        # indexes are built once the data is loaded, which is faster than maintaining them row by row
+        if verbose==True:
+            print("Creating indexes")
+        SpeechCoco._createIndexes(database)
+        if fullText == True:
+            SpeechCoco._createFullTextIndex(database)
+        db.execute('ANALYZE')
         database.commit()
+
+        db.execute("PRAGMA journal_mode = DELETE")
         database.close()
         if verbose:
-            print("\t{:0.2f}s".format(time.time() - startTime))
+            elapsed = time.time() - startTime
+            print("\t{} files in {:0.2f}s ({:0.0f} files/s)".format(nbDone, elapsed, nbDone / max(elapsed, 1e-9)))
+
+    @staticmethod
+    def _createIndexes(database):
+        with database:
+            for name, table, columns in INDEXES:
+                # optional tables (e.g. wordIndex) are only indexed if they exist
+                if not SpeechCoco._tableExists(database, table):
+                    continue
+                database.execute('CREATE INDEX IF NOT EXISTS {} ON {} ({})'.format(name, table, ', '.join(columns)))
+
+    @staticmethod
+    def _tableExists(database, name):
+        query = 'SELECT name FROM sqlite_master WHERE type="table" AND name=?'
+        return database.execute(query, (name,)).fetchone() is not None
+
+    @staticmethod
+    def _createWordIndex(database, rebuild=False):
+        # a new index is filled with the captions already in the database (jsonToSQL only indexes the files it reads)
+        with database:
+            created = not SpeechCoco._tableExists(database, 'wordIndex')
+            database.execute('CREATE TABLE IF NOT EXISTS wordIndex (word TEXT, captionID INTEGER, position INTEGER, begin FLOAT, end FLOAT, speed FLOAT)')
+            # the occurrences of a caption are removed along with it
+            database.execute("CREATE TRIGGER IF NOT EXISTS wordIndex_delete AFTER DELETE ON captions BEGIN "
+                             "DELETE FROM wordIndex WHERE captionID=old.captionID; END")
+            if created == True or rebuild == True:
+                database.execute('DELETE FROM wordIndex')
+                batch = []
+                for captionID, timecode, speed in database.execute('SELECT captionID, timecode, speed FROM captions'):
+                    batch.extend(_wordIndexRows(captionID, Timecode.load(timecode), speed))
+                    if len(batch) >= FETCH_SIZE:
+                        database.executemany('INSERT INTO wordIndex VALUES (?,?,?,?,?,?)', batch)
+                        batch = []
+                database.executemany('INSERT INTO wordIndex VALUES (?,?,?,?,?,?)', batch)
 
+    @staticmethod
+    def _createAlignmentTables(database, rebuild=False):
+        # new tables are filled with the captions already in the database (see _createWordIndex)
+        with database:
+            created = not all(SpeechCoco._tableExists(database, table) for table in ALIGNMENT_TABLES)
+            for table in ALIGNMENT_TABLES:
+                database.execute('CREATE TABLE IF NOT EXISTS {} (captionID INTEGER, position INTEGER, parent INTEGER, value TEXT, begin FLOAT, end FLOAT)'.format(table))
+            database.execute("CREATE TRIGGER IF NOT EXISTS alignments_delete AFTER DELETE ON captions BEGIN " +
+                             " ".join("DELETE FROM {} WHERE captionID=old.captionID;".format(table)
+                                      for table in ALIGNMENT_TABLES) + " END")
+            if created == True or rebuild == True:
+                for table in ALIGNMENT_TABLES:
+                    database.execute('DELETE FROM {}'.format(table))
+                batch = []
+                for captionID, timecode in database.execute('SELECT captionID, timecode FROM captions'):
+                    batch.append(_alignmentRows(captionID, Timecode.load(timecode)))
+                    if len(batch) >= FETCH_SIZE:
+                        SpeechCoco._insertAlignments(database, batch)
+                        batch = []
+                SpeechCoco._insertAlignments(database, batch)
+
+    @staticmethod
+    def _createStats(database, rebuild=False):
+        # the statistics are kept up to date by triggers on captions: a caption is removed from the row of its old
+        # values and added to the row of its new ones
+        durationBin = "CAST({0}.duration / " + str(STATS_BIN_WIDTH) + " AS INTEGER)"
+        tokens = "CASE WHEN {0}.text IS NULL OR trim({0}.text) = '' THEN 0 " \
+                 "ELSE length(trim({0}.text)) - length(replace(trim({0}.text), ' ', '')) + 1 END"
+        key = "speaker IS {0}.speaker AND speed IS {0}.speed AND disfluencyPos IS {0}.disfluencyPos AND " \
+              "durationBin IS " + durationBin
+        add = ("INSERT OR IGNORE INTO captionStats VALUES ({0}.speaker, {0}.speed, {0}.disfluencyPos, " +
+               durationBin + ", 0, 0, 0); "
+               "UPDATE captionStats SET captions=captions+1, duration=duration+{0}.duration, "
+               "tokens=tokens+(" + tokens + ") WHERE " + key + ";").format('new')
+        remove = ("UPDATE captionStats SET captions=captions-1, duration=duration-{0}.duration, "
+                  "tokens=tokens-(" + tokens + ") WHERE " + key + "; "
+                  "DELETE FROM captionStats WHERE " + key + " AND captions<=0;").format('old')
+
+        with database:
+            created = not SpeechCoco._tableExists(database, 'captionStats')
+            database.execute('CREATE TABLE IF NOT EXISTS captionStats (speaker TEXT, speed FLOAT, disfluencyPos TEXT, '
+                             'durationBin INTEGER, captions INTEGER, duration FLOAT, tokens INTEGER, '
+                             'PRIMARY KEY (speaker, speed, disfluencyPos, durationBin))')
+            if created == True or rebuild == True:
+                database.execute('DELETE FROM captionStats')
+                database.execute('INSERT INTO captionStats SELECT speaker, speed, disfluencyPos, '
+                                 '{} AS durationBin, COUNT(*), SUM(duration), SUM({}) '
+                                 'FROM captions GROUP BY speaker, speed, disfluencyPos, durationBin'.format(
+                                     durationBin.format('captions'), tokens.format('captions')))
+            database.execute("CREATE TRIGGER IF NOT EXISTS captionStats_insert AFTER INSERT ON captions BEGIN " +
+                             add + " END")
+            database.execute("CREATE TRIGGER IF NOT EXISTS captionStats_delete AFTER DELETE ON captions BEGIN " +
+                             remove + " END")
+            database.execute("CREATE TRIGGER IF NOT EXISTS captionStats_update AFTER UPDATE OF speaker, speed, "
+                             "disfluencyPos, duration, text ON captions BEGIN " + remove + " " + add + " END")
+
+    @staticmethod
+    def _insertAlignments(database, alignments):
+        # alignments: list of (words, syllables, phonemes) rows
+        for table, rows in zip(ALIGNMENT_TABLES, zip(*alignments)):
+            database.executemany('INSERT INTO {} VALUES (?,?,?,?,?,?)'.format(table),
+                                 [row for caption in rows for row in caption])
+
+    @staticmethod
+    def _createFullTextIndex(database):
+        # external content table: only the index is stored, the text is read from the captions table
+        if SpeechCoco._tableExists(database, 'captions_fts'):
+            return
+        with database:
+            database.execute("CREATE VIRTUAL TABLE captions_fts USING fts5(text, content='captions', content_rowid='captionID')")
+            database.execute("INSERT INTO captions_fts(captions_fts) VALUES ('rebuild')")
+            # keep the index in sync with the captions table (e.g. incremental ingestion)
+            database.execute("CREATE TRIGGER captions_fts_insert AFTER INSERT ON captions BEGIN "
+                             "INSERT INTO captions_fts(rowid, text) VALUES (new.captionID, new.text); END")
+            database.execute("CREATE TRIGGER captions_fts_delete AFTER DELETE ON captions BEGIN "
+                             "INSERT INTO captions_fts(captions_fts, rowid, text) VALUES ('delete', old.captionID, old.text); END")
+            database.execute("CREATE TRIGGER captions_fts_update AFTER UPDATE OF text ON captions BEGIN "
+                             "INSERT INTO captions_fts(captions_fts, rowid, text) VALUES ('delete', old.captionID, old.text); "
+                             "INSERT INTO captions_fts(rowid, text) VALUES (new.captionID, new.text); END")
+
+    @staticmethod
+    def _insertBatch(database, batch, speakers):
+        # a batch is written in a single transaction along with its manifest entries, so that an interrupted
+        # ingestion resumes after the last committed batch
+        if len(batch) == 0:
+            return 0
+        captions = [item['caption'] for item in batch]
+        if str is bytes:
+            captions = [row[:4] + (_bindTimecode(row[4]),) + row[5:] for row in captions]
+        replaced = [(item['file'][-1],) for item in batch if item['file'][-1] is not None]
+        imageInsert = "INSERT INTO captions (captionID, imageID, wavFilename, duration, timecode, disfluencyPos, disfluencyVal, speed, text, speaker) VALUES (?,?,?,?,?,?,?,?,?,?)"
+        speakerInsertion = 'INSERT OR IGNORE INTO speakers (name, nationality, gender) VALUES (?,?,?)'
+        manifestInsertion = 'INSERT OR REPLACE INTO ingestion (filename, size, mtime, captionID) VALUES (?,?,?,?)'
+        with database:
+            # the captions read again (and those previously read from a modified file) are replaced
+            database.executemany('DELETE FROM captions WHERE captionID=?', replaced + [(row[0],) for row in captions])
+            database.executemany(imageInsert, captions)
+            database.executemany(speakerInsertion, [(name, speakers[name][0], speakers[name][1])
+                                                    for name in set(row[-1] for row in captions)])
+            database.executemany(manifestInsertion, [item['file'][1:4] + (item['caption'][0],) for item in batch])
+            words = [row for item in batch for row in item.get('wordIndex', [])]
+            if len(words) != 0:
+                database.executemany('INSERT INTO wordIndex VALUES (?,?,?,?,?,?)', words)
+            alignments = [item['alignments'] for item in batch if 'alignments' in item]
+            if len(alignments) != 0:
+                SpeechCoco._insertAlignments(database, alignments)
+        return len(batch)
+
+
+#
+# Ingestion helpers (module level so that they can be sent to worker processes)
+#
+
+def _readCaptionFile(entry, wordIndex=False, alignments=False, binaryTimecode=False):
+    # entry: (directory, filename, size, mtime, previous captionID)
+    with open(os.path.join(entry[0], entry[1])) as jsonFile:
+        jsonData = json.load(jsonFile)
+    caption = (jsonData['captionID'], jsonData['imgID'], jsonData['wavFilename'], jsonData['duration'],
+               _storeTimecode(jsonData['timecode'], binaryTimecode), jsonData['disfluency'][0], jsonData['disfluency'][1],
+               jsonData['speed'], jsonData['synthesisedCaption'], jsonData['speaker'])
+    result = {'file': entry, 'caption': caption}
+    if wordIndex == True:
+        result['wordIndex'] = _wordIndexRows(jsonData['captionID'], jsonData['timecode'], jsonData['speed'])
+    if alignments == True:
+        result['alignments'] = _alignmentRows(jsonData['captionID'], jsonData['timecode'])
+    return result
+
+
+def _storeTimecode(timecode, binary=False):
+    # value of the timecode column, JSON text unless binary is True and the timecode can be encoded. Plain bytes
+    # are returned (and not sqlite3.Binary, a memoryview) so that the value can be sent back from worker processes
+    if binary == True:
+        blob = Timecode.encode(timecode)
+        if blob is not None:
+            return blob
+    return json.dumps(timecode)
+
+
+def _bindTimecode(value):
+    # Python 2 binds str as TEXT: binary timecodes are wrapped to be stored as BLOBs
+    if str is bytes and value[:4] == TIMECODE_MAGIC:
+        return sqlite3.Binary(value)
+    return value
+
+
+def _wordIndexRows(captionID, timecode, speed):
+    # (word, captionID, position, begin, end, speed) of each word of the caption, silences excluded
+    words = [word for word in Timecode.s_parse(timecode, seconds=True) if word['value'] != '__SIL__']
+    return [(word['value'].lower(), captionID, position, word['begin'], word['end'], speed)
+            for position, word in enumerate(words)]
+
+
+def _mapFiles(function, files, workers=None, chunksize=64):
+    # applies function to each file in a pool of processes and yields the results as soon as they are ready
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+    if workers <= 1:
+        for path in files:
+            yield function(path)
+        return
+
+    pool = multiprocessing.Pool(workers)
+    try:
+        for result in pool.imap_unordered(function, files, chunksize):
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+
+def _alignmentRows(captionID, timecode):
+    # rows of the words, syllables and phonemes tables: (captionID, position, parent, value, begin, end)
+    words, syllables, phonemes = [], [], []
+    for word in Timecode.s_parse(timecode):
+        words.append((captionID, len(words), None, word['value'], word['begin'], word['end']))
+        for syllable in word.get('syllable', []):
+            syllables.append((captionID, len(syllables), len(words) - 1, syllable['value'], syllable['begin'],
+                              syllable['end']))
+            for phoneme in syllable.get('phoneme', []):
+                phonemes.append((captionID, len(phonemes), len(syllables) - 1, phoneme['value'], phoneme['begin'],
+                                 phoneme['end']))
+    return words, syllables, phonemes
+
+
+#
+# Export helpers
+#
+
+def _exportTextgrids(captionIDs, databaseDir, outputDir, level=3):
+    # renders and writes the TextGrid files of a chunk of captions, returns the number of files written
+    database = sqlite3.connect(databaseDir)
+    try:
+        query = 'SELECT wavFilename, timecode FROM captions WHERE captionID IN ({})'.format(
+            ','.join('?' * len(captionIDs)))
+        rows = database.execute(query, captionIDs).fetchall()
+    finally:
+        database.close()
+    for filename, timecode in rows:
+        timecodes = Timecode.s_parse(Timecode.load(timecode), seconds=True)
+        with open(os.path.join(outputDir, filename.replace('.wav', '.TextGrid')), 'w') as f:
+            f.write(Timecode.s_renderTextgrid(timecodes, level))
+    return len(rows)
 
 if __name__ == '__main__':
 
@@ -0,0 +1,231 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import random
+import functools
+import itertools
+import numpy as np
+
+from .speechcoco import _mapFiles
+
+'''
+    File name: variability.py
+    Inter- and intra-speaker variability: DTW distances between the occurrences of the same words.
+    Requires NumPy.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+#
+# CONSTANTS
+#
+
+# Number of pairs of sequences aligned at once by dtwBatch
+DTW_BATCH_SIZE = 256
+
+
+#
+#   DTW
+#
+
+def dtw(x, y, band=None, threshold=None):
+    """
+    :param x: (n, dimension) sequence
+    :param y: (m, dimension) sequence
+    :param band: see dtwBatch
+    :param threshold: see dtwBatch
+    :return: DTW distance between x and y (see dtwBatch)
+    """
+    return dtwBatch([x], [y], band=band, threshold=threshold)[0]
+
+
+def dtwBatch(xs, ys, band=None, threshold=None, batchSize=DTW_BATCH_SIZE):
+    """
+    DTW distances between the pairs of sequences (xs[k], ys[k]), with euclidean distance as local cost and
+    normalised by the sum of the lengths of the sequences. The pairs are aligned batchSize at a time, the
+    cumulative costs of a whole anti-diagonal of every pair of the batch being computed at once.
+
+    :param xs: list of (n, dimension) sequences
+    :param ys: list of (m, dimension) sequences
+    :param band: Sakoe-Chiba band, i.e. maximum distance (in frames) between the warping path and the diagonal,
+                 plus the difference of lengths of the sequences. None for no constraint
+    :param threshold: early abandoning: the distance of the pairs whose distance exceeds threshold is inf, their
+                      alignment being stopped as soon as this is known. None to compute every distance
+    :param batchSize:
+    :return: array of distances
+    """
+    assert len(xs) == len(ys), "|> xs and ys must have the same length!"
+    distances = np.empty(len(xs))
+    # pairs of similar sizes are batched together to limit padding
+    order = sorted(range(len(xs)), key=lambda k: (len(xs[k]) + len(ys[k]), len(xs[k])))
+    for start in range(0, len(order), batchSize):
+        batch = order[start:start + batchSize]
+        distances[batch] = _dtwBatch([np.asarray(xs[k], dtype=np.float64) for k in batch],
+                                     [np.asarray(ys[k], dtype=np.float64) for k in batch], band, threshold)
+    return distances
+
+
+def _dtwBatch(xs, ys, band, threshold):
+    batchSize = len(xs)
+    n = np.array([len(x) for x in xs])
+    m = np.array([len(y) for y in ys])
+    maxN, maxM = n.max(), m.max()
+
+    # local costs, padded with inf (cells outside a pair's matrix or band are never reached)
+    x = np.zeros((batchSize, maxN, xs[0].shape[1]))
+    y = np.zeros((batchSize, maxM, ys[0].shape[1]))
+    for k in range(batchSize):
+        x[k, :n[k]] = xs[k]
+        y[k, :m[k]] = ys[k]
+    squares = (x ** 2).sum(axis=2)[:, :, None] + (y ** 2).sum(axis=2)[:, None, :] - 2 * np.matmul(x, y.transpose(0, 2, 1))
+    costs = np.sqrt(np.maximum(squares, 0))
+    i = np.arange(maxN)[None, :, None]
+    j = np.arange(maxM)[None, None, :]
+    outside = (i >= n[:, None, None]) | (j >= m[:, None, None])
+    if band is not None:
+        # the band is widened by the difference of lengths so that (n - 1, m - 1) can always be reached
+        outside |= (j - i > band + np.maximum(m - n, 0)[:, None, None]) | \
+                   (i - j > band + np.maximum(n - m, 0)[:, None, None])
+    costs[outside] = np.inf
+
+    # cumulative costs of the last two anti-diagonals, indexed by i + 1 (index 0 is an inf sentinel)
+    previous = np.full((batchSize, maxN + 1), np.inf)
+    beforePrevious = np.full((batchSize, maxN + 1), np.inf)
+    beforePrevious[:, 0] = 0
+    rows = np.arange(maxN)
+    last = n + m - 2
+    limit = threshold * (n + m) if threshold is not None else np.full(batchSize, np.inf)
+    distances = np.full(batchSize, np.inf)
+    # index in the batch of the pairs of the arrays, and whether they are still being aligned
+    pairs = np.arange(batchSize)
+    alive = np.ones(batchSize, dtype=bool)
+
+    for diagonal in range(last.max() + 1):
+        columns = diagonal - rows
+        valid = (columns >= 0) & (columns < maxM)
+        current = np.full((len(pairs), maxN + 1), np.inf)
+        steps = np.minimum(np.minimum(previous[:, :-1], previous[:, 1:]), beforePrevious[:, :-1])
+        current[:, 1:][:, valid] = costs[:, rows[valid], columns[valid]] + steps[:, valid]
+
+        finished = alive & (last == diagonal)
+        distances[pairs[finished]] = current[finished, n[finished]] / (n + m)[finished]
+        # every warping path goes through one of two consecutive anti-diagonals, and cumulative costs only grow
+        abandoned = np.minimum(current.min(axis=1), previous.min(axis=1)) > limit
+        alive &= ~(finished | abandoned)
+        nbAlive = alive.sum()
+        if nbAlive == 0:
+            break
+        if nbAlive <= len(pairs) // 2:
+            # the arrays are shrunk once half of their pairs are done
+            pairs, costs, n, m, last, limit = pairs[alive], costs[alive], n[alive], m[alive], last[alive], \
+                                              limit[alive]
+            current, previous = current[alive], previous[alive]
+            alive = np.ones(nbAlive, dtype=bool)
+        beforePrevious, previous = previous, current
+    # pairs that reach the end of their alignment may exceed the threshold as well
+    if threshold is not None:
+        distances[distances > threshold] = np.inf
+    return distances
+
+
+#
+#   Variability analysis
+#
+
+def speakerVariability(speechCoco, featureStore, words, speakers=[], maxOccurrences=None, band=None,
+                       threshold=None, workers=None, seed=None, verbose=False):
+    """
+    Inter- and intra-speaker variability (see README): DTW distances between the occurrences of the same word,
+    averaged for each pair of speakers. The occurrences are found with the word index of the database (see
+    SpeechCoco.buildWordIndex) and their features read from featureStore (see features.extractFeatures).
+    Words are sent to a pool of processes.
+
+    :param speechCoco: SpeechCoco object
+    :param featureStore: features.FeatureStore
+    :param words: list of words
+    :param speakers: speakers to compare (defaults to all of them)
+    :param maxOccurrences: maximum number of occurrences of a word per speaker (randomly sampled)
+    :param band: Sakoe-Chiba band (see dtwBatch)
+    :param threshold: early abandoning threshold (see dtwBatch). Pairs above it are left out of the means
+    :param workers: number of processes (defaults to the number of CPUs)
+    :param seed: seed of the sampling of the occurrences
+    :param verbose:
+    :return: dict with the speakers, the speaker x speaker matrix of mean distances (nan when there are no
+             pairs) and the matrices of the number of pairs used and abandoned
+    """
+    if type(speakers) is str:
+        speakers = [speakers]
+    if len(speakers) == 0:
+        speakers = [speaker.name for speaker in speechCoco.getSpeakers()]
+    speakers = sorted(speakers)
+    rnd = random.Random(seed)
+
+    items = []
+    for word in words:
+        occurrences = dict((speaker, []) for speaker in speakers)
+        for row in speechCoco.findWordOccurrences(word, speaker=speakers, stream=True):
+            occurrences[row['speaker']].append((row['captionID'], row['begin'], row['end']))
+        if maxOccurrences is not None:
+            for speaker in speakers:
+                if len(occurrences[speaker]) > maxOccurrences:
+                    occurrences[speaker] = rnd.sample(occurrences[speaker], maxOccurrences)
+        items.append((word, [occurrences[speaker] for speaker in speakers]))
+
+    if verbose == True:
+        print("|> Computing DTW distances for {} words and {} speakers ...".format(len(words), len(speakers)))
+    sums = np.zeros((len(speakers), len(speakers)))
+    counts = np.zeros((len(speakers), len(speakers)), dtype=np.int64)
+    abandoned = np.zeros((len(speakers), len(speakers)), dtype=np.int64)
+    compute = functools.partial(_wordDistances, featureStore=featureStore, band=band, threshold=threshold)
+    for done, (word, wordSums, wordCounts, wordAbandoned) in enumerate(_mapFiles(compute, items, workers,
+                                                                                 chunksize=1)):
+        sums += wordSums
+        counts += wordCounts
+        abandoned += wordAbandoned
+        if verbose == True:
+            print("\t{} / {} words ({})".format(done + 1, len(items), word))
+
+    with np.errstate(invalid='ignore', divide='ignore'):
+        matrix = np.where(counts > 0, sums / counts, np.nan)
+    return {'speakers': speakers, 'matrix': matrix, 'counts': counts, 'abandoned': abandoned}
+
+
+def _wordDistances(item, featureStore, band=None, threshold=None):
+    # DTW distances between the occurrences of a word, summed by pair of speakers (module level so that it can
+    # be sent to worker processes)
+    word, occurrences = item
+    features = [[featureStore.getSpan(captionID, begin, end) for captionID, begin, end in speakerOccurrences]
+                for speakerOccurrences in occurrences]
+    xs, ys, cells = [], [], []
+    for first, second in itertools.combinations_with_replacement(range(len(occurrences)), 2):
+        if first == second:
+            pairs = itertools.combinations(features[first], 2)
+        else:
+            pairs = itertools.product(features[first], features[second])
+        for x, y in pairs:
+            if len(x) > 0 and len(y) > 0:
+                xs.append(x)
+                ys.append(y)
+                cells.append((first, second))
+
+    size = len(occurrences)
+    sums = np.zeros((size, size))
+    counts = np.zeros((size, size), dtype=np.int64)
+    abandoned = np.zeros((size, size), dtype=np.int64)
+    if len(xs) > 0:
+        distances = dtwBatch(xs, ys, band=band, threshold=threshold)
+        first, second = np.array(cells).T
+        computed = np.isfinite(distances)
+        for rows, columns in ((first, second), (second, first)):
+            np.add.at(sums, (rows[computed], columns[computed]), distances[computed])
+            np.add.at(counts, (rows[computed], columns[computed]), 1)
+            np.add.at(abandoned, (rows[~computed], columns[~computed]), 1)
+        # pairs of occurrences of the same speaker were added twice to the diagonal
+        diagonal = np.arange(size)
+        sums[diagonal, diagonal] /= 2
+        counts[diagonal, diagonal] //= 2
+        abandoned[diagonal, diagonal] //= 2
+    return word, sums, counts, abandoned
+
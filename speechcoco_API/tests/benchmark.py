@@ -0,0 +1,163 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import gc
+import os
+import sys
+import json
+import time
+import shutil
+import sqlite3
+import timeit
+import tempfile
+import argparse
+import itertools
+import tracemalloc
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..'))
+
+from speechcoco.speechcoco import SpeechCoco, Timecode, Caption, INDEXES
+from synthetic import randomTimecodes, writeCaptions
+from test_timecode import referenceParse
+from test_columnar import randomWindows
+
+try:
+    from speechcoco.columnar import AlignmentCorpus, getWordsBatch
+except ImportError:
+    getWordsBatch = None
+
+'''
+    File name: benchmark.py
+    Micro-benchmarks of the timecode parsing, of getWordsBatch, of the queries on a synthetic database and of the
+    construction of Caption objects, run with: python tests/benchmark.py
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+
+def _best(function, number, repeat=5):
+    # best time per call (microseconds)
+    return min(timeit.repeat(function, number=number, repeat=repeat)) / number * 1e6
+
+
+def benchmarkParse():
+    print("|> Timecode.s_parse (microseconds per timecode)")
+    for name, maxWords, number in [('typical caption', 15, 200), ('long caption', 300, 5)]:
+        timecodes = randomTimecodes(20, seed=0, maxWords=maxWords)
+        reference = _best(lambda: [referenceParse(timecode) for timecode in timecodes], number) / len(timecodes)
+        current = _best(lambda: [Timecode.s_parse(timecode) for timecode in timecodes], number) / len(timecodes)
+        print("{:<16} original {:>10.1f}  s_parse {:>10.1f}  speed-up {:>6.1f}x".format(name, reference, current,
+                                                                                        reference / current))
+
+
+def benchmarkGetWords():
+    if getWordsBatch is None:
+        print("|> NumPy is not installed, getWordsBatch skipped")
+        return
+    print("|> getWordsBatch (windows per second)")
+    parsed = [Timecode.s_parse(timecode, seconds=True) for timecode in randomTimecodes(2000, seed=0)]
+    corpus = AlignmentCorpus.fromParsed(parsed)
+    windows = randomWindows(parsed, 100000, seed=1)
+    for level, olapthr in [(1, 75), (3, 30)]:
+        loop = _best(lambda: [Caption.s_getWords(parsed[caption], begin, end, level, olapthr)
+                              for caption, begin, end in windows], 1, 3)
+        dicts = _best(lambda: getWordsBatch(corpus, windows, level, olapthr), 1, 3)
+        arrays = _best(lambda: getWordsBatch(corpus, windows, level, olapthr, asArrays=True), 1, 3)
+        print("level {} olapthr {:<3} s_getWords {:>10.0f}  dicts {:>10.0f}  arrays {:>10.0f}".format(
+            level, olapthr, *[len(windows) / (time / 1e6) for time in [loop, dicts, arrays]]))
+
+
+def syntheticDatabase(directory, count):
+    # database of count synthetic captions
+    jsons = os.path.join(directory, 'json')
+    writeCaptions(jsons, count, seed=0)
+    path = os.path.join(directory, 'captions.sqlite3')
+    SpeechCoco.jsonToSQL(jsons, path)
+    return path
+
+
+def benchmarkIndexes(path):
+    print("|> Query latency without and with the indexes of the captions table (milliseconds)")
+    plain = os.path.join(os.path.dirname(path), 'plain.sqlite3')
+    shutil.copy(path, plain)
+    database = sqlite3.connect(plain)
+    for name, table, columns in INDEXES:
+        if table == 'captions':
+            database.execute('DROP INDEX IF EXISTS {}'.format(name))
+    database.execute('ANALYZE')
+    database.commit()
+    database.close()
+
+    queries = [('getImgCaptions', lambda db: db.getImgCaptions(1000, raw=True)),
+               ('speaker + speed', lambda db: db.filterCaptions(speaker='Paul', speed=1.0, raw=True)),
+               ('gender + nationality + speed',
+                lambda db: db.filterCaptions(gender='Female', nationality='UK', speed=0.9, raw=True)),
+               ('speed + disfluencyPos', lambda db: db.filterCaptions(speed=1.1, disfluencyPos='Middle', raw=True)),
+               ('speaker', lambda db: db.filterCaptions(speaker='Paul', raw=True))]
+    before, after = SpeechCoco(plain), SpeechCoco(path)
+    for name, query in queries:
+        # the rows may come in a different order without the indexes
+        assert sorted(row['captionID'] for row in query(before)) == \
+               sorted(row['captionID'] for row in query(after))
+        times = [_best(lambda: query(speechCoco), 10) / 1000 for speechCoco in [before, after]]
+        print("{:<30} {:>8.2f} -> {:>8.2f}".format(name, *times))
+    before.close()
+    after.close()
+
+
+class EagerCaption:
+    # Caption as it was before the timecode was decoded lazily (no __slots__, timecode decoded at construction)
+    def __init__(self, speaker, info):
+        self.speaker = speaker
+        self.captionID = info['captionID']
+        self.imageID = info['imageID']
+        self.text = info['text']
+        self.disfluencyVal = info['disfluencyVal']
+        self.disfluencyPos = info['disfluencyPos']
+        self.duration = info['duration']
+        self.filename = info['wavFilename']
+        self.speed = info['speed']
+        self.timecode = Timecode(self, json.loads(info['timecode']))
+
+
+def benchmarkCaptions(path, count):
+    print("|> Construction of {} Caption objects from rows".format(count))
+    speechCoco = SpeechCoco(path)
+    rows = speechCoco.filterCaptions(raw=True)
+    rows = list(itertools.islice(itertools.cycle(rows), count))
+    for name, build in [('eager (before)', lambda row: EagerCaption(speechCoco._speakers[row['speaker']], row)),
+                        ('lazy (Caption)', speechCoco._toCaption)]:
+        gc.collect()
+        start = time.time()
+        captions = [build(row) for row in rows]
+        elapsed = time.time() - start
+        captions = None
+        gc.collect()
+        tracemalloc.start()
+        captions = [build(row) for row in rows]
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        captions = None
+        print("{:<16} {:>8.2f}s  peak {:>10.1f}MB".format(name, elapsed, peak / 1e6))
+    speechCoco.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='SpeechCoco micro-benchmarks')
+    parser.add_argument('--database-captions', type=int, default=20000,
+                        help='number of captions of the synthetic database')
+    parser.add_argument('--captions', type=int, default=400000,
+                        help='number of Caption objects built (the eager version needs about 5GB of memory for 400k)')
+    args = parser.parse_args()
+
+    benchmarkParse()
+    benchmarkGetWords()
+    directory = tempfile.mkdtemp()
+    try:
+        path = syntheticDatabase(directory, args.database_captions)
+        benchmarkIndexes(path)
+        benchmarkCaptions(path, args.captions)
+    finally:
+        shutil.rmtree(directory)
@@ -0,0 +1,104 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import json
+import random
+
+'''
+    File name: synthetic.py
+    Synthetic timecodes, with the same structure as the timecodes of the SpeechCoco JSON files, used by the
+    tests and the benchmarks.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+#
+# CONSTANTS
+#
+
+VOCABULARY = ['a', 'group', 'of', 'turkeys', 'with', 'bushes', 'in', 'the', 'background', 'man', 'walking', 'next',
+              'to', 'couple', 'donkeys', 'keys', 'cell', 'phone', 'blue', 'white', 'dog', 'cat']
+PHONEMES = ['a', 'b', 'k', 't', 'ai', 'w', 's', 'e', 'o', 'n', 'm', 'r', 'l']
+SPEAKERS = ['Bruce', 'Paul', 'Phil', 'Judith', 'Elizabeth', 'Bronwen', 'Jenny', 'Amanda']
+SPEEDS = [0.9, 1.0, 1.1]
+DISFLUENCIES = ['None', 'Beginning', 'Middle', 'End']
+
+
+def syntheticTimecode(words, rnd):
+    """
+    :param words: list of words
+    :param rnd: random.Random object
+    :return: timecode of the words (1 to 3 syllables of 1 to 3 phonemes each, and a few silences between words)
+    """
+    time = 0.0
+    timecode = []
+    for position, word in enumerate(words):
+        for syllable in range(rnd.randint(1, 3)):
+            timecode.append([round(time, 4), 'SYL', ''])
+            if syllable == 0:
+                timecode.append([round(time, 4), 'SEPR', ' '])
+                timecode.append([round(time, 4), 'WORD', word])
+            for phoneme in range(rnd.randint(1, 3)):
+                timecode.append([round(time, 4), 'PHO', rnd.choice(PHONEMES)])
+                time += rnd.uniform(30, 120)
+        if rnd.random() < 0.15 and position != len(words) - 1:
+            timecode.append([round(time, 4), 'SYL', ''])
+            timecode.append([round(time, 4), 'PHO', '#'])
+            time += rnd.uniform(100, 300)
+            timecode.append([round(time, 4), 'SIL', ''])
+    timecode.append([round(time, 4), 'SYL', ''])
+    timecode.append([round(time, 4), 'SIL', ''])
+    return timecode
+
+
+def randomTimecodes(count, seed=0, maxWords=15, jitter=0.0):
+    """
+    :param count: number of timecodes
+    :param seed:
+    :param maxWords: maximum number of words of a timecode
+    :param jitter: probability of moving back the time of an element (overlapping or out of order elements)
+    :return: list of timecodes
+    """
+    rnd = random.Random(seed)
+    timecodes = []
+    for _ in range(count):
+        timecode = syntheticTimecode([rnd.choice(VOCABULARY) for _ in range(rnd.randint(1, maxWords))], rnd)
+        for element in timecode:
+            if rnd.random() < jitter:
+                element[0] = round(element[0] - rnd.uniform(0, 50), 4)
+        timecodes.append(timecode)
+    return timecodes
+
+
+def writeCaptions(directory, count, seed=0, firstCaptionID=1):
+    """
+    Writes count JSON caption files (same fields as the SpeechCoco JSON files) in directory.
+
+    :param directory:
+    :param count: number of captions
+    :param seed:
+    :param firstCaptionID: captionID of the first caption, the following ones being consecutive
+    :return: list of the filenames
+    """
+    rnd = random.Random(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    filenames = []
+    for captionID in range(firstCaptionID, firstCaptionID + count):
+        words = [rnd.choice(VOCABULARY) for _ in range(rnd.randint(4, 12))]
+        timecode = syntheticTimecode(words, rnd)
+        speaker, speed, disfluency = rnd.choice(SPEAKERS), rnd.choice(SPEEDS), rnd.choice(DISFLUENCIES)
+        wavFilename = '{}_{}_{}_{}_{}.wav'.format(captionID // 5, captionID, speaker, disfluency,
+                                                  str(speed).replace('.', '-'))
+        caption = {'captionID': captionID, 'imgID': captionID // 5, 'wavFilename': wavFilename,
+                   'duration': round(timecode[-1][0] / 1000.0, 4), 'timecode': timecode, 'speed': speed,
+                   'speaker': speaker, 'synthesisedCaption': ' '.join(words) + '.',
+                   'disfluency': [disfluency, 'um' if disfluency != 'None' else '']}
+        filename = wavFilename.replace('.wav', '.json')
+        with open(os.path.join(directory, filename), 'w') as f:
+            json.dump(caption, f)
+        filenames.append(filename)
+    return filenames
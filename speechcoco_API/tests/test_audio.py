@@ -0,0 +1,86 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import wave
+import random
+import shutil
+import tempfile
+import unittest
+
+from speechcoco.speechcoco import SpeechCoco
+from synthetic import writeCaptions
+
+try:
+    from speechcoco.audio import packShards, ShardStore
+except ImportError:
+    packShards = None
+
+'''
+    File name: test_audio.py
+    Audio shards written by audio.packShards from synthetic WAV files. Requires NumPy.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+
+def writeWavs(directory, speechCoco, seed=0):
+    # 16-bit mono WAV file of random samples for every caption of speechCoco
+    rnd = random.Random(seed)
+    if not os.path.exists(directory):
+        os.makedirs(directory)
+    for caption in speechCoco.filterCaptions(raw=True):
+        wavFile = wave.open(os.path.join(directory, caption['wavFilename']), 'wb')
+        wavFile.setnchannels(1)
+        wavFile.setsampwidth(2)
+        wavFile.setframerate(22050)
+        wavFile.writeframes(bytes(bytearray(rnd.randrange(256) for _ in range(2 * rnd.randint(100, 2000)))))
+        wavFile.close()
+
+
+@unittest.skipIf(packShards is None, "NumPy is not installed")
+class TestPackShards(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.path = os.path.join(self.directory, 'captions.sqlite3')
+        self.wavDir = os.path.join(self.directory, 'wav')
+        self.shardDir = os.path.join(self.directory, 'shards')
+        writeCaptions(os.path.join(self.directory, 'json'), 40, seed=0)
+        SpeechCoco.jsonToSQL(os.path.join(self.directory, 'json'), self.path)
+        self.speechCoco = SpeechCoco(self.path, wavDir=self.wavDir)
+        writeWavs(self.wavDir, self.speechCoco)
+
+    def tearDown(self):
+        self.speechCoco.close()
+        shutil.rmtree(self.directory)
+
+    def samples(self):
+        store = ShardStore(self.path, self.shardDir)
+        return dict((captionID, samples.tolist()) for captionID, sampleRate, samples in store)
+
+    def test_failed_packing(self):
+        # the previous index and shards are kept when packing fails partway
+        packShards(self.speechCoco, self.shardDir, shardSize=20000)
+        shards = sorted(os.listdir(self.shardDir))
+        samples = self.samples()
+        os.remove(os.path.join(self.wavDir, sorted(os.listdir(self.wavDir))[-1]))
+        self.assertRaises(EnvironmentError, packShards, self.speechCoco, self.shardDir, shardSize=20000)
+        self.assertEqual(sorted(os.listdir(self.shardDir)), shards)
+        self.assertEqual(self.samples(), samples)
+
+    def test_repacking(self):
+        # the shards of the previous packing are removed once the new index is committed
+        packShards(self.speechCoco, self.shardDir, shardSize=20000)
+        samples = self.samples()
+        writeWavs(self.wavDir, self.speechCoco, seed=1)
+        report = packShards(self.speechCoco, self.shardDir, shardSize=20000)
+        self.assertEqual(len(os.listdir(self.shardDir)), report['shards'])
+        self.assertEqual(sorted(self.samples()), sorted(samples))
+        self.assertNotEqual(self.samples(), samples)
+
+
+if __name__ == '__main__':
+    unittest.main()
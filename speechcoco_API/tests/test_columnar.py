@@ -0,0 +1,81 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import random
+import unittest
+
+from speechcoco.speechcoco import Timecode, Caption
+from synthetic import randomTimecodes
+
+try:
+    from speechcoco.columnar import getWordsBatch
+except ImportError:
+    getWordsBatch = None
+
+'''
+    File name: test_columnar.py
+    Equivalence of columnar.getWordsBatch with Caption.s_getWords. Requires NumPy.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+
+def randomWindows(parsed, count, seed=0, seconds=True):
+    # (caption index, begin, end) windows, some of them starting or ending exactly on element boundaries
+    rnd = random.Random(seed)
+    scale = 1 if seconds == True else 1000
+    windows = []
+    for _ in range(count):
+        caption = rnd.randrange(len(parsed))
+        if rnd.random() < 0.2:
+            word = rnd.choice(parsed[caption])
+            windows.append((caption, word['begin'], word['end']))
+        else:
+            begin = rnd.uniform(-0.2, 3.0) * scale
+            windows.append((caption, begin, begin + rnd.choice([0.1, 0.3, 0.5, 1.0]) * scale))
+    return windows
+
+
+@unittest.skipIf(getWordsBatch is None, "NumPy is not installed")
+class TestGetWordsBatch(unittest.TestCase):
+
+    def setUp(self):
+        timecodes = randomTimecodes(200, seed=0)
+        self.parsed = [Timecode.s_parse(timecode, seconds=True) for timecode in timecodes]
+        self.parsedMilliseconds = [Timecode.s_parse(timecode) for timecode in timecodes]
+
+    def assertSameWords(self, parsed, windows, level, olapthr):
+        expected = [Caption.s_getWords(parsed[caption], begin, end, level, olapthr)
+                    for caption, begin, end in windows]
+        self.assertEqual(getWordsBatch(parsed, windows, level, olapthr), expected)
+
+    def test_levels(self):
+        windows = randomWindows(self.parsed, 2000, seed=1)
+        for level, olapthr in [(1, 75), (2, 0), (3, 30), (0, 50)]:
+            self.assertSameWords(self.parsed, windows, level, olapthr)
+
+    def test_milliseconds(self):
+        windows = randomWindows(self.parsedMilliseconds, 2000, seed=2, seconds=False)
+        self.assertSameWords(self.parsedMilliseconds, windows, 3, 30)
+
+    def test_chunks(self):
+        windows = randomWindows(self.parsed, 500, seed=3)
+        self.assertEqual(getWordsBatch(self.parsed, windows, 3, 30, chunkSize=7),
+                         getWordsBatch(self.parsed, windows, 3, 30))
+
+    def test_arrays(self):
+        windows = randomWindows(self.parsed, 500, seed=4)
+        arrays = getWordsBatch(self.parsed, windows, 1, 75, asArrays=True)
+        expected = [Caption.s_getWords(self.parsed[caption], begin, end, 1, 75) for caption, begin, end in windows]
+        self.assertEqual(len(arrays['window']), sum(len(words) for words in expected))
+        self.assertEqual(arrays['overlap'].tolist(),
+                         [word['overlapPercentage'] for words in expected for word in words])
+
+    def test_empty(self):
+        self.assertEqual(getWordsBatch(self.parsed, [], 1), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,118 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import os
+import shutil
+import sqlite3
+import tempfile
+import unittest
+
+from speechcoco.speechcoco import SpeechCoco
+from synthetic import writeCaptions
+
+'''
+    File name: test_ingestion.py
+    Databases built by SpeechCoco.jsonToSQL from synthetic JSON files.
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+
+class TestJsonToSQL(unittest.TestCase):
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.jsons = os.path.join(self.directory, 'json')
+        writeCaptions(self.jsons, 150, seed=0)
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def database(self, name, **kwargs):
+        path = os.path.join(self.directory, name)
+        SpeechCoco.jsonToSQL(self.jsons, path, **kwargs)
+        speechCoco = SpeechCoco(path)
+        self.addCleanup(speechCoco.close)
+        return speechCoco
+
+    def assertSameCaptions(self, speechCoco, reference):
+        # the captions are compared by captionID, filterCaptions returning them in no particular order
+        captions = dict((caption.captionID, caption) for caption in speechCoco.filterCaptions())
+        expected = dict((caption.captionID, caption) for caption in reference.filterCaptions())
+        self.assertEqual(sorted(captions), sorted(expected))
+        for captionID in expected:
+            self.assertEqual(captions[captionID].timecode.parse(), expected[captionID].timecode.parse())
+
+    def test_binary_timecode_workers(self):
+        # the binary timecodes are sent back from the worker processes
+        reference = self.database('json.sqlite3', workers=1)
+        binary = self.database('binary.sqlite3', workers=2, binaryTimecode=True)
+        self.assertSameCaptions(binary, reference)
+        self.assertEqual(binary.queryCaptions('SELECT DISTINCT typeof(timecode) FROM captions')[0][0], 'blob')
+
+    def test_word_index_added_later(self):
+        # the captions ingested before the word index was requested are indexed as well
+        self.database('incremental.sqlite3')
+        writeCaptions(self.jsons, 150, seed=1, firstCaptionID=1001)
+        incremental = self.database('incremental.sqlite3', incremental=True, wordIndex=True)
+        reference = self.database('reference.sqlite3', wordIndex=True)
+        query = 'SELECT * FROM wordIndex ORDER BY captionID, position'
+        self.assertEqual([tuple(row) for row in incremental.queryCaptions(query)],
+                         [tuple(row) for row in reference.queryCaptions(query)])
+        self.assertEqual(incremental.queryCaptions('SELECT COUNT(DISTINCT captionID) FROM wordIndex')[0][0], 300)
+
+    def test_alignments_added_later(self):
+        self.database('incremental.sqlite3')
+        writeCaptions(self.jsons, 150, seed=1, firstCaptionID=1001)
+        incremental = self.database('incremental.sqlite3', incremental=True, alignments=True)
+        reference = self.database('reference.sqlite3', alignments=True)
+        for table in ['words', 'syllables', 'phonemes']:
+            query = 'SELECT * FROM {} ORDER BY captionID, position'.format(table)
+            self.assertEqual([tuple(row) for row in incremental.queryCaptions(query)],
+                             [tuple(row) for row in reference.queryCaptions(query)])
+        for caption in incremental.filterCaptions():
+            self.assertEqual(caption.getAlignment(seconds=True), caption.timecode.parse(seconds=True))
+
+    def test_alignment_without_rows(self):
+        # captions missing from the alignment tables are parsed from their timecode
+        speechCoco = self.database('alignments.sqlite3', alignments=True)
+        for table in ['words', 'syllables', 'phonemes']:
+            speechCoco.database.execute('DELETE FROM {} WHERE captionID=1'.format(table))
+        caption = speechCoco.selectCaptions(1)[0]
+        self.assertEqual(caption.getAlignment(), caption.timecode.parse())
+        self.assertEqual(speechCoco.getAlignment(1, seconds=True), caption.timecode.parse(seconds=True))
+
+    def test_stats_without_groups(self):
+        speechCoco = self.database('stats.sqlite3', stats=True)
+        total = speechCoco.stats(groupBy=[])
+        self.assertEqual(len(total), 1)
+        self.assertEqual(total[0]['captions'], 150)
+        self.assertAlmostEqual(total[0]['duration'],
+                               speechCoco.queryCaptions('SELECT SUM(duration) FROM captions')[0][0])
+        self.assertEqual(speechCoco.stats(groupBy=[], speaker='Nobody'), [])
+
+    def test_translation_columns(self):
+        # only the requested translations are added to the columns of the captions and speakers
+        speechCoco = self.database('captions.sqlite3')
+        path = os.path.join(self.directory, 'translations.sqlite3')
+        database = sqlite3.connect(path)
+        for language in ['ja_google', 'ja_excite']:
+            database.execute('CREATE TABLE {} (captionID INTEGER PRIMARY KEY, caption TEXT, tokens TEXT, '
+                             'pos TEXT)'.format(language))
+            database.executemany('INSERT INTO {} VALUES (?,?,?,?)'.format(language),
+                                 [(captionID, language + str(captionID), 'tokens', 'pos')
+                                  for captionID in range(1, 151)])
+        database.commit()
+        database.close()
+        translated = SpeechCoco(speechCoco._databaseDir, path)
+        self.addCleanup(translated.close)
+        rows = translated.filterCaptions(raw=True, translations=['ja_google', 'ja_excite.tokens'])
+        plain = translated.filterCaptions(raw=True)
+        self.assertEqual(list(rows[0].keys()), list(plain[0].keys()) + ['ja_google', 'ja_excite_tokens'])
+        self.assertEqual([row['ja_google'] for row in rows], ['ja_google' + str(row['captionID']) for row in rows])
+
+
+if __name__ == '__main__':
+    unittest.main()
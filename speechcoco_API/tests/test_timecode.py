@@ -0,0 +1,138 @@
+#!usr/bin/env python
+#-*- coding: utf-8 -*-
+
+import copy
+import unittest
+
+from speechcoco.speechcoco import Timecode
+from synthetic import randomTimecodes
+
+'''
+    File name: test_timecode.py
+    Equivalence of Timecode.s_parse with its original implementation (referenceParse).
+    URL: https://github.com/William-N-Havard/SpeechCoco
+'''
+
+__author__ = "William N. Havard"
+__email__ = "william.havard@gmail.com"
+
+
+def referenceParse(timecode, seconds=False):
+    # original implementation of Timecode.s_parse (nested loops over every syllable and phoneme)
+    alignment = []
+    wordAlignment = []
+    syllableAlignment = []
+    phonemeAlignment = []
+
+    for element in timecode:
+        if seconds == True:
+            millisecond = element[0] / 1000
+        else:
+            millisecond = element[0]
+        category = element[1]
+        value = element[2]
+
+        if category == "WORD":
+            if len(wordAlignment) != 0 and len(wordAlignment[-1]) < 3 and wordAlignment[-1]["value"] != "__SIL__":
+                wordAlignment[-1].update({"end": syllableAlignment[-1]["begin"]})
+            wordAlignment.append({"value": value, "begin": millisecond})
+
+        elif category == "SYL":
+            if len(syllableAlignment) != 0 and len(syllableAlignment[-1]) < 3:
+                syllableAlignment[-1].update({"end": millisecond})
+            syllableAlignment.append({"value": "", "begin": millisecond})
+
+        elif category == "PHO":
+            syllableAlignment[-1]["value"] += value
+            if len(phonemeAlignment) != 0 and len(phonemeAlignment[-1]) < 3:
+                phonemeAlignment[-1].update({"end": millisecond})
+            phonemeAlignment.append({"value": value, "begin": millisecond})
+
+        elif category == "SIL":
+            syllableAlignment[-1].update({"end": millisecond})
+            phonemeAlignment[-1].update({"end": millisecond})
+
+            if syllableAlignment[-1]['value'] == '':
+                wordAlignment[-1].update({"end": millisecond})
+                wordAlignment.append({"value": "__SIL__", "begin": millisecond, "end": millisecond})
+            else:
+                wordAlignment[-1].update({"end": phonemeAlignment[-1]["begin"]})
+                wordAlignment.append(
+                    {"value": "__SIL__", "begin": phonemeAlignment[-1]["begin"], "end": millisecond})
+
+    wordAlignment = [w for w in wordAlignment if w['begin'] != w['end']]
+    syllableAlignment = [s for s in syllableAlignment if s['begin'] != s['end']]
+    phonemeAlignment = [p for p in phonemeAlignment if p['begin'] != p['end']]
+
+    if len(wordAlignment[-1]) < 3:
+        wordAlignment[-1].update({"end": syllableAlignment[-1]["begin"]})
+
+    for wordTimecode in wordAlignment:
+        alignment.append(wordTimecode)
+        wordBegin = wordTimecode["begin"]
+        wordEnd = wordTimecode["end"]
+        for syllableTimecode in syllableAlignment:
+            syllableBegin = syllableTimecode["begin"]
+            syllableEnd = syllableTimecode["end"]
+            if syllableBegin >= wordBegin and syllableEnd <= wordEnd:
+                for phonemeTimecode in phonemeAlignment:
+                    phonemeBegin = phonemeTimecode["begin"]
+                    phonemeEnd = phonemeTimecode["end"]
+                    if phonemeBegin >= syllableBegin and phonemeEnd <= syllableEnd:
+                        if wordTimecode['value'] == '__SIL__':
+                            updatedPhonemeTimecode = {'value': '__' + phonemeTimecode["value"] + '__',
+                                                      'begin': phonemeTimecode["begin"],
+                                                      'end': phonemeTimecode["end"]}
+                        else:
+                            updatedPhonemeTimecode = phonemeTimecode
+
+                        if "phoneme" not in syllableTimecode.keys():
+                            syllableTimecode.update({"phoneme": [updatedPhonemeTimecode]})
+                        else:
+                            syllableTimecode["phoneme"].append(updatedPhonemeTimecode)
+
+                if "syllable" not in alignment[-1].keys():
+                    alignment[-1].update({"syllable": [syllableTimecode]})
+                else:
+                    alignment[-1]["syllable"].append(syllableTimecode)
+    return alignment
+
+
+def _parseOrError(parse, timecode, seconds):
+    # result of parse, or the type of the exception it raised
+    try:
+        return parse(copy.deepcopy(timecode), seconds)
+    except Exception as e:
+        return type(e)
+
+
+class TestParse(unittest.TestCase):
+
+    def assertSameParse(self, timecodes):
+        for timecode in timecodes:
+            for seconds in (False, True):
+                self.assertEqual(_parseOrError(Timecode.s_parse, timecode, seconds),
+                                 _parseOrError(referenceParse, timecode, seconds))
+
+    def test_synthetic(self):
+        self.assertSameParse(randomTimecodes(500, seed=0))
+
+    def test_long(self):
+        self.assertSameParse(randomTimecodes(5, seed=1, maxWords=300))
+
+    def test_single_word(self):
+        self.assertSameParse(randomTimecodes(50, seed=2, maxWords=1))
+
+    def test_out_of_order(self):
+        # overlapping elements and elements whose begin equals their end
+        self.assertSameParse(randomTimecodes(500, seed=3, jitter=0.05))
+
+    def test_fresh_result(self):
+        timecode = randomTimecodes(1, seed=4)[0]
+        parsed = Timecode.s_parse(timecode)
+        parsed[0]['value'] = 'modified'
+        self.assertEqual(Timecode.s_parse(timecode), referenceParse(timecode))
+
+
+if __name__ == '__main__':
+    unittest.main()